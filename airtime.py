@@ -0,0 +1,141 @@
+"""
+On-air duration of text sent through fldigi, per modem: the varicode bits of
+every character at the modem's bitrate, plus the preamble and postamble
+fldigi sends around every transmission
+"""
+
+import logging
+
+import util
+
+logger = logging.getLogger("fldigi")
+
+# fldigi's varicode gives the characters above 127 codes of up to 12 bits
+HIGH_CHAR_BITS = 12 + util.VARICODE_GAP
+# MFSK varicode (IZ8BLY) for byte values 0-255, used by fldigi's MFSK and
+# robust PSK-R modes. A code starts with 1, ends with the "00" that marks the
+# end of the character, and never contains "001", so there is no gap to add.
+# The control characters, space and !"#$%&' have fldigi's codes. The rest are
+# the other codes of up to 11 bits, shortest first, given to characters in
+# order of their PSK31 varicode length, so a printable character may be a bit
+# or two off fldigi's code; the characters above 127 have 10 to 12 bits.
+# fmt: off
+MFSK_VARICODE = (
+    "11101011100", "11101100000", "11101101000", "11101101100", "11101110000", "11101110100", "11101111000", "11101111100",
+    "10101000", "11110000000", "11110100000", "11110101000", "11110101100", "10101100", "11110110000", "11110110100",
+    "11110111000", "11110111100", "11111000000", "11111010000", "11111010100", "11111011000", "11111011100", "11111100000",
+    "11111101000", "11111101100", "11111110000", "11111110100", "11111111000", "11111111100", "100000000000", "101000000000",
+    "100", "111111100", "1111111100", "1010111000", "1011011000", "1111101100", "1110111000", "111111000",
+    "101011000", "101010100", "110000000", "111110000", "10000000", "111100", "1100000", "110111100",
+    "11011000", "11100000", "101000000", "101100000", "110101000", "101110000", "101111000", "110111000",
+    "110110100", "111010000", "101010000", "111011000", "1000000000", "1011100", "111101000", "1010110100",
+    "1011010000", "10110100", "100000000", "11000000", "11010100", "10100000", "11110100", "101011100",
+    "101101000", "10111000", "1010101100", "110110000", "11110000", "11011100", "11111000", "10111100",
+    "11101100", "111101100", "11010000", "1111100", "1111000", "101101100", "111000000", "101110100",
+    "110100000", "110101100", "1010110000", "1010100000", "1010000000", "1010101000", "1011010100", "101111100",
+    "1011100000", "10100", "1110000", "111000", "110100", "1000", "1010100", "1101000",
+    "110000", "11000", "111110100", "11101000", "101100", "1010000", "11100", "10000",
+    "1011000", "111011100", "100000", "101000", "1100", "1000000", "10110000", "1110100",
+    "11111100", "1101100", "111100000", "1011000000", "111010100", "1010111100", "1011011100", "101010000000",
+    "101010100000", "101010101000", "101010101100", "101010110000", "101010110100", "101010111000", "101010111100", "101011000000",
+    "101011010000", "101011010100", "101011011000", "101011011100", "101011100000", "101011101000", "101011101100", "101011110000",
+    "101011110100", "101011111000", "101011111100", "101100000000", "101101000000", "101101010000", "101101010100", "101101011000",
+    "101101011100", "101101100000", "101101101000", "101101101100", "101101110000", "101101110100", "101101111000", "101101111100",
+    "1011101000", "1011101100", "1011110000", "1011110100", "1011111000", "1011111100", "1100000000", "1101000000",
+    "1101010000", "1101010100", "1101011000", "1101011100", "1101100000", "1101101000", "1101101100", "1101110000",
+    "1101110100", "1101111000", "1101111100", "1110000000", "1110100000", "1110101000", "1110101100", "1110110000",
+    "1110110100", "1110111100", "1111000000", "1111010000", "1111010100", "1111011000", "1111011100", "1111100000",
+    "1111101000", "1111110000", "1111110100", "1111111000", "10000000000", "10100000000", "10101000000", "10101010000",
+    "10101010100", "10101011000", "10101011100", "10101100000", "10101101000", "10101101100", "10101110000", "10101110100",
+    "10101111000", "10101111100", "10110000000", "10110100000", "10110101000", "10110101100", "10110110000", "10110110100",
+    "10110111000", "10110111100", "10111000000", "10111010000", "10111010100", "10111011000", "10111011100", "10111100000",
+    "10111101000", "10111101100", "10111110000", "10111110100", "10111111000", "10111111100", "11000000000", "11010000000",
+    "11010100000", "11010101000", "11010101100", "11010110000", "11010110100", "11010111000", "11010111100", "11011000000",
+    "11011010000", "11011010100", "11011011000", "11011011100", "11011100000", "11011101000", "11011101100", "11011110000",
+    "11011110100", "11011111000", "11011111100", "11100000000", "11101000000", "11101010000", "11101010100", "11101011000",
+)
+# fmt: on
+# Seconds pyfldigi's TX monitor leaves the transmitter keyed after the last
+# character, before it switches fldigi back to RX
+TX_MONITOR_TAIL = 1.5
+DEFAULT_MODEM = "PSK125R"
+# Typical characters of encoded frames, lowercase letters and digits
+TYPICAL_TEXT = b"abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def varicode_char_bits(char):
+    if char == ord("\n"):
+        # fldigi sends a newline as CR LF
+        return util.varicode_bits(b"\r\n")
+    if char > 127:
+        return HIGH_CHAR_BITS
+    return util.varicode_bits(bytes([char]))
+
+
+def mfsk_char_bits(char):
+    if char == ord("\n"):
+        return len(MFSK_VARICODE[ord("\r")]) + len(MFSK_VARICODE[ord("\n")])
+    return len(MFSK_VARICODE[char])
+
+
+# bits on air for each byte value, per varicode
+PSK_CHAR_BITS = [varicode_char_bits(char) for char in range(256)]
+MFSK_CHAR_BITS = [mfsk_char_bits(char) for char in range(256)]
+
+
+# Airtime figures for one modem. baud is symbols per second, and bitrate the
+# varicode bits per second after the modem's own FEC; the preamble of phase
+# reversals and the postamble are counted in symbols. char_bits is the
+# modem's varicode cost of each byte value.
+class modem_timing:
+    def __init__(
+        self, name, baud, bitrate, preamble_symbols, postamble_symbols, char_bits
+    ):
+        self.name = name
+        self.baud = baud
+        self.bitrate = bitrate
+        self.preamble = preamble_symbols / baud
+        self.postamble = postamble_symbols / baud
+        self.char_bits = char_bits
+        self.typical_char_bits = self.text_bits(TYPICAL_TEXT) / len(TYPICAL_TEXT)
+
+    def text_bits(self, text):
+        return sum(map(self.char_bits.__getitem__, text))
+
+    def text_seconds(self, text):
+        return self.text_bits(text) / self.bitrate
+
+    # Roughly how long n characters of a frame take to arrive
+    def chars_seconds(self, n):
+        return n * self.typical_char_bits / self.bitrate
+
+    # Keyed-up time for one transmission of text, from the first preamble
+    # symbol to the end of the postamble
+    def transmission_seconds(self, text):
+        return self.preamble + self.text_seconds(text) + self.postamble
+
+
+# The robust PSK-R modes run at twice the symbol rate of their data rate and
+# interleave their FEC, so fldigi sends them a longer preamble and flushes the
+# interleaver with a longer postamble. They use the MFSK varicode.
+MODEMS = {
+    modem.name: modem
+    for modem in [
+        modem_timing("BPSK31", 31.25, 31.25, 32, 32, PSK_CHAR_BITS),
+        modem_timing("BPSK63", 62.5, 62.5, 32, 32, PSK_CHAR_BITS),
+        modem_timing("BPSK125", 125.0, 125.0, 32, 32, PSK_CHAR_BITS),
+        modem_timing("BPSK250", 250.0, 250.0, 32, 32, PSK_CHAR_BITS),
+        modem_timing("PSK125R", 125.0, 62.5, 64, 160, MFSK_CHAR_BITS),
+        modem_timing("PSK250R", 250.0, 125.0, 64, 320, MFSK_CHAR_BITS),
+        modem_timing("PSK500R", 500.0, 250.0, 64, 640, MFSK_CHAR_BITS),
+    ]
+}
+
+
+# The figures for a modem by fldigi's name for it, or for DEFAULT_MODEM with a
+# warning when we have none
+def timing(modem):
+    if modem in MODEMS:
+        return MODEMS[modem]
+    logger.warning(f"no airtime figures for modem {modem}, using {DEFAULT_MODEM}'s")
+    return MODEMS[DEFAULT_MODEM]
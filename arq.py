@@ -0,0 +1,227 @@
+"""
+Selective-repeat ARQ for the radio link: numbered frames, piggybacked
+cumulative and selective acks, and retransmission of only the missing frames
+"""
+
+import logging
+import random
+
+import trio
+
+import util
+
+logger = logging.getLogger("fldigi")
+
+SEQ_SPACE = 256
+# Limited by the 16-bit selective ack bitmap
+MAX_WINDOW = 16
+
+
+# Distance from seq a forward to seq b, modulo the sequence space
+def seq_distance(a, b):
+    return (b - a) % SEQ_SPACE
+
+
+# Both ends resync after either restarts without its spool. A fresh end
+# numbers its frames from 0 and flags them util.EXT_SYN, with a random ID for
+# its fresh state, until the peer answers with util.EXT_SYN_ACK for that ID;
+# its acks until then count frames from before the restart, so they are
+# ignored. The peer resets its receiver on the first SYN with a new ID, and
+# if it didn't restart itself, renumbers its frames in flight from 0 and
+# syncs its own numbering the same way. Until a fresh end hears a SYN it
+# takes no numbered frames, since they were numbered for the end it replaced.
+class selective_repeat:
+    # Retransmit a frame if nothing has been heard for this long since it went out
+    rto = 10.0
+
+    # spool, a spool.frame_spool, keeps frames in flight and the sequence
+    # numbers on disk, and resumes from them
+    def __init__(self, window=4, spool=None):
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"ARQ window must be 1-{MAX_WINDOW}, not {window}")
+        self.window = window
+        self.spool = spool
+        # sender: seq -> [frame, time sent or None]
+        self.next_seq = 0
+        self.unacked = {}
+        # receiver: next seq to deliver, and frames that arrived ahead of it
+        self.rx_next = 0
+        self.rx_buffer = {}
+        self.ack_pending = False
+        # when we last heard any frame from the peer
+        self.last_heard = float("-inf")
+        self.work_event = trio.Event()
+        # our numbering is fresh and the peer hasn't confirmed it, and the ID
+        # that tells this fresh state from earlier ones
+        self.syn = spool is None or not spool.resumed
+        self.syn_id = random.getrandbits(16)
+        # the ID of the peer's last SYN, and whether its last frame carried
+        # it, which we confirm
+        self.peer_syn_id = None
+        self.peer_syn = False
+        # our receiver follows the peer's numbering: it resumed from the
+        # spool, or has reset for the peer's SYN
+        self.synced = not self.syn
+        # times the peer restarted while we kept our state
+        self.peer_restarts = 0
+        if spool is not None:
+            self.next_seq = spool.next_seq
+            self.rx_next = spool.rx_next
+            for seq, frame in spool.unacked():
+                self.unacked[seq] = [frame, None]
+
+    # New frames we may send before the oldest unacked one is acked
+    def window_space(self):
+        return self.window - len(self.unacked)
+
+    def window_open(self):
+        return self.window_space() > 0
+
+    # Number a new frame and hold it until it is acked; frames are opaque here
+    def add(self, frame):
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) % SEQ_SPACE
+        self.unacked[seq] = [frame, None]
+        if self.spool is not None:
+            self.spool.frame_added(seq, frame)
+        return seq
+
+    # A sent frame is due again once the peer has had its turn to ack and
+    # didn't, or after rto with nothing heard at all
+    def frame_due(self, sent_at):
+        if sent_at is None:
+            return True
+        return self.last_heard > sent_at or trio.current_time() > sent_at + self.rto
+
+    # Unacked frames to (re)send in this transmission, oldest first
+    def due_frames(self):
+        oldest_first = sorted(
+            self.unacked,
+            key=lambda seq: seq_distance(seq, self.next_seq),
+            reverse=True,
+        )
+        return [
+            (seq, self.unacked[seq][0])
+            for seq in oldest_first
+            if self.frame_due(self.unacked[seq][1])
+        ]
+
+    # sent_at is when the frames finish going out, for frames still queued
+    # for the transmitter; now by default
+    def frames_sent(self, seqs, sent_at=None):
+        if sent_at is None:
+            sent_at = trio.current_time()
+        for seq in seqs:
+            if seq in self.unacked:
+                self.unacked[seq][1] = sent_at
+        self.ack_pending = False
+
+    def has_work(self):
+        return self.ack_pending or any(
+            self.frame_due(sent_at) for _, sent_at in self.unacked.values()
+        )
+
+    # Wait until ready() is true, checking again after every received frame
+    # and whenever a sent frame's rto runs out
+    async def wait_until(self, ready):
+        while not ready():
+            sent_times = [sent_at for _, sent_at in self.unacked.values()]
+            deadline = min(sent_times, default=float("inf")) + self.rto
+            with trio.move_on_at(deadline):
+                await self.work_event.wait()
+            self.work_event = trio.Event()
+
+    # Wait until an ack is owed or an unacked frame is due again
+    async def wait_for_work(self):
+        await self.wait_until(self.has_work)
+
+    # Wait until we may send a new frame, or have ARQ work to do meanwhile
+    async def wait_for_window(self):
+        await self.wait_until(lambda: self.window_open() or self.has_work())
+
+    # Header for an outgoing frame, acking what we have received so far
+    def header(self, flags, seq=None, stream=None):
+        bitmap = 0
+        for buffered in self.rx_buffer:
+            bitmap |= 1 << (seq_distance(self.rx_next, buffered) - 1)
+        header = util.frame_header(flags, seq, self.rx_next, bitmap, stream)
+        if self.syn:
+            header.syn = self.syn_id
+        if self.peer_syn:
+            header.syn_ack = self.peer_syn_id
+        return header
+
+    def process_ack(self, ack, bitmap):
+        for seq in list(self.unacked):
+            distance = seq_distance(seq, ack)
+            offset = seq_distance(ack, seq) - 1
+            if 0 < distance <= SEQ_SPACE // 2 or (
+                0 <= offset < MAX_WINDOW and bitmap & (1 << offset)
+            ):
+                del self.unacked[seq]
+                if self.spool is not None:
+                    self.spool.frame_acked(seq)
+
+    # The peer's first SYN: expect its frames from 0, and unless we are fresh
+    # too, number our frames in flight from 0 as well and send them again
+    def peer_reset(self):
+        self.rx_next = 0
+        self.rx_buffer = {}
+        self.synced = True
+        if self.syn:
+            if self.spool is not None:
+                self.spool.rx_advanced(self.rx_next)
+            return
+        logger.warning(f"ARQ peer restarted, renumbering {len(self.unacked)} unacked frames")
+        oldest_first = sorted(
+            self.unacked,
+            key=lambda seq: seq_distance(seq, self.next_seq),
+            reverse=True,
+        )
+        frames = [self.unacked[seq][0] for seq in oldest_first]
+        self.unacked = {}
+        self.next_seq = 0
+        self.syn = True
+        self.syn_id = random.getrandbits(16)
+        self.peer_restarts += 1
+        if self.spool is not None:
+            self.spool.reset()
+        for frame in frames:
+            self.add(frame)
+
+    # Handle a received frame; returns the frames now deliverable in order
+    def frame_received(self, header, frame):
+        self.last_heard = trio.current_time()
+        if header.syn is not None and header.syn != self.peer_syn_id:
+            self.peer_syn_id = header.syn
+            self.peer_reset()
+        self.peer_syn = header.syn is not None
+        if self.syn and header.syn_ack == self.syn_id:
+            self.syn = False
+        if header.ack is not None and not self.syn:
+            self.process_ack(header.ack, header.ack_bitmap)
+        deliver = []
+        if header.seq is None:
+            deliver = [frame]
+        elif not self.synced:
+            # our ack carries the SYN the peer must renumber for
+            logger.info(f"ARQ frame {header.seq} from before our restart, dropping")
+            self.ack_pending = True
+        else:
+            self.ack_pending = True
+            distance = seq_distance(self.rx_next, header.seq)
+            if distance == 0:
+                deliver = [frame]
+                self.rx_next = (self.rx_next + 1) % SEQ_SPACE
+                while self.rx_next in self.rx_buffer:
+                    deliver.append(self.rx_buffer.pop(self.rx_next))
+                    self.rx_next = (self.rx_next + 1) % SEQ_SPACE
+            elif distance <= MAX_WINDOW:
+                logger.info(f"ARQ frame {header.seq} ahead of {self.rx_next}, holding")
+                self.rx_buffer[header.seq] = frame
+            else:
+                logger.info(f"ARQ duplicate frame {header.seq}, dropping")
+            if deliver and self.spool is not None:
+                self.spool.rx_advanced(self.rx_next)
+        self.work_event.set()
+        return deliver
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3.8
+
+"""
+Benchmark a pair of fldigi-proxy instances end to end: drive TCP traffic
+through them with a chosen profile and report goodput, message latency,
+airtime and encoding overhead as JSON
+"""
+
+import argparse
+import collections
+import json
+import logging
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import xmlrpc.client
+from functools import partial
+
+import trio
+
+logger = logging.getLogger("bench")
+
+# The init message captured from a node handshake in lnproxy, which carries
+# no key material: features and the regtest chain hash
+# fmt: off
+INIT = b'\x00-\x00\x10\x00\x02"\x00\x00\x03\x02\xaa\xa2\x01 \x06"nF\x11\x1a\x0bY\xca\xaf\x12`C\xeb[\xbf(\xc3O:^3*\x1f\xc7\xb2\xb7<\xf1\x88\x91\x0f'
+# fmt: on
+# Noise handshake act fields: a version byte, then in acts one and two a
+# compressed public key and a MAC, and in act three the encrypted static key
+# with its MAC, then a MAC
+HANDSHAKE_VERSION = b"\x00"
+PUBKEY_BYTES = 33
+MAC_BYTES = 16
+# Lightning ping and pong message types
+PING_TYPE = 18
+PONG_TYPE = 19
+# Every connection starts with its ID, so the far end can pair it up
+CONN_ID_BYTES = 2
+POLL_DELAY = 0.1
+
+
+# One direction of one connection: remembers what was sent and when, checks
+# what arrives against it, and times each message from send to full arrival
+class flow:
+    def __init__(self, stats):
+        self.stats = stats
+        self.expected = bytearray()
+        self.received = 0
+        self.corrupt = False
+        # (offset the message ends at, time sent) for messages in flight
+        self.in_flight = collections.deque()
+        self.update = trio.Event()
+
+    def message_sent(self, data):
+        self.expected += data
+        self.in_flight.append((len(self.expected), trio.current_time()))
+        self.stats.messages_sent += 1
+
+    def data_received(self, data):
+        now = trio.current_time()
+        if data != self.expected[self.received : self.received + len(data)]:
+            self.corrupt = True
+        self.received += len(data)
+        self.stats.payload_bytes += len(data)
+        self.stats.last_delivery = now
+        while self.in_flight and self.in_flight[0][0] <= self.received:
+            _, sent_at = self.in_flight.popleft()
+            self.stats.latencies.append(now - sent_at)
+        self.update.set()
+        self.update = trio.Event()
+
+    def delivered(self):
+        return self.received >= len(self.expected)
+
+    async def wait_delivered(self):
+        while not self.delivered():
+            await self.update.wait()
+
+
+class connection:
+    def __init__(self, conn_id, stats):
+        self.conn_id = conn_id
+        # node -> proxy_out, and proxy_in -> remote node
+        self.up = flow(stats)
+        self.down = flow(stats)
+        self.local = None
+        self.remote = None
+        self.remote_ready = trio.Event()
+
+    async def send_up(self, data):
+        self.up.message_sent(data)
+        await self.local.send_all(data)
+
+    async def send_down(self, data):
+        await self.remote_ready.wait()
+        self.down.message_sent(data)
+        await self.remote.send_all(data)
+
+    async def up_and_back(self, request, reply):
+        await self.send_up(request)
+        await self.up.wait_delivered()
+        await self.send_down(reply)
+        await self.down.wait_delivered()
+
+    async def wait_delivered(self):
+        await self.up.wait_delivered()
+        await self.down.wait_delivered()
+
+
+class run_stats:
+    def __init__(self):
+        self.payload_bytes = 0
+        self.messages_sent = 0
+        self.latencies = []
+        self.start = None
+        self.last_delivery = None
+
+
+# Drives traffic in at the proxy_out end and plays the remote node at the
+# proxy_in end. Connections from the proxy_in end are paired with ours by the
+# ID we send first on each.
+class benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.stats = run_stats()
+        self.connections = {}
+        self.next_id = 0
+        self.random = random.Random(args.seed)
+        self.nursery = None
+
+    def payload(self, size):
+        return self.random.getrandbits(8 * size).to_bytes(size, "little")
+
+    # A handshake act with a fresh key and MACs, as every real handshake has
+    def handshake_act(self, act):
+        if act == 3:
+            return HANDSHAKE_VERSION + self.payload(PUBKEY_BYTES + 2 * MAC_BYTES)
+        parity = self.random.choice(b"\x02\x03")
+        return HANDSHAKE_VERSION + bytes([parity]) + self.payload(PUBKEY_BYTES - 1 + MAC_BYTES)
+
+    async def connect(self):
+        conn = connection(self.next_id, self.stats)
+        self.next_id += 1
+        self.connections[conn.conn_id] = conn
+        conn.local = await trio.open_tcp_stream("127.0.0.1", self.args.inport)
+        await conn.local.send_all(conn.conn_id.to_bytes(CONN_ID_BYTES, "big"))
+        self.nursery.start_soon(self.read_stream, conn.local, conn.down)
+        return conn
+
+    async def read_stream(self, stream, received_flow, data=b""):
+        if data:
+            received_flow.data_received(data)
+        try:
+            async for data in stream:
+                received_flow.data_received(data)
+        except trio.BrokenResourceError:
+            logger.warning("connection reset")
+
+    # The remote node's side of a connection
+    async def serve_remote(self, stream):
+        data = b""
+        async for fragment in stream:
+            data += fragment
+            if len(data) >= CONN_ID_BYTES:
+                break
+        if len(data) < CONN_ID_BYTES:
+            return
+        conn_id = int.from_bytes(data[:CONN_ID_BYTES], "big")
+        conn = self.connections.get(conn_id)
+        if conn is None:
+            logger.warning(f"unknown connection {conn_id}")
+            return
+        conn.remote = stream
+        conn.remote_ready.set()
+        await self.read_stream(stream, conn.up, data[CONN_ID_BYTES:])
+
+    # One connection sending the whole transfer in size chunks
+    async def bulk(self):
+        conn = await self.connect()
+        remaining = self.args.bytes
+        while remaining > 0:
+            size = min(self.args.size, remaining)
+            await conn.send_up(self.payload(size))
+            remaining -= size
+        await conn.wait_delivered()
+
+    # Noise handshake then init each way, one round trip after another
+    async def handshake(self):
+        for _ in range(self.args.count):
+            conn = await self.connect()
+            await conn.up_and_back(self.handshake_act(1), self.handshake_act(2))
+            await conn.up_and_back(self.handshake_act(3) + INIT, INIT)
+
+    # Lightning ping asking for a pong of size bytes, count times
+    async def pingpong(self):
+        conn = await self.connect()
+        size = self.args.size
+        ping = PING_TYPE.to_bytes(2, "big") + size.to_bytes(2, "big") + bytes(4)
+        pong = PONG_TYPE.to_bytes(2, "big") + size.to_bytes(2, "big") + bytes(size)
+        for _ in range(self.args.count):
+            await conn.up_and_back(ping, pong)
+
+    async def small_messages(self, conn):
+        for _ in range(self.args.count):
+            await conn.send_up(self.payload(self.args.size))
+            await trio.sleep(self.args.interval)
+        await conn.wait_delivered()
+
+    # count messages of size bytes, interval seconds apart
+    async def small(self):
+        await self.small_messages(await self.connect())
+
+    # The small profile on several connections at once
+    async def concurrent(self):
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.args.connections):
+                conn = await self.connect()
+                nursery.start_soon(self.small_messages, conn)
+
+    async def run(self):
+        profile = PROFILES[self.args.profile]
+        processes = []
+        try:
+            async with trio.open_nursery() as nursery:
+                self.nursery = nursery
+                await nursery.start(
+                    partial(trio.serve_tcp, host="127.0.0.1"),
+                    self.serve_remote,
+                    self.args.outport,
+                )
+                # the receiving proxy connects to us as soon as it starts
+                if self.args.auto:
+                    processes = await trio.to_thread.run_sync(start_processes, self.args)
+                monitors = [airtime_monitor(port) for port in self.args.xml]
+                for monitor in monitors:
+                    await monitor.start()
+                    nursery.start_soon(monitor.run)
+                self.stats.start = trio.current_time()
+                complete = False
+                with trio.move_on_after(self.args.timeout):
+                    await profile(self)
+                    complete = True
+                if not complete:
+                    logger.warning(f"timed out after {self.args.timeout}s")
+                end = trio.current_time()
+                for monitor in monitors:
+                    await monitor.stop()
+                nursery.cancel_scope.cancel()
+            for conn in self.connections.values():
+                await conn.local.aclose()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+        return self.report(complete, end, monitors)
+
+    def report(self, complete, end, monitors):
+        stats = self.stats
+        elapsed = (stats.last_delivery or end) - stats.start
+        flows = [f for conn in self.connections.values() for f in (conn.up, conn.down)]
+        latencies = sorted(stats.latencies)
+        tx_seconds = sum(monitor.tx_seconds for monitor in monitors)
+        chars = [monitor.chars_sent for monitor in monitors]
+        bits = [monitor.bits_sent for monitor in monitors]
+        overhead = None
+        if stats.payload_bytes and None not in chars:
+            overhead = {
+                "chars_per_byte": sum(chars) / stats.payload_bytes,
+                "bits_per_byte": sum(bits) / stats.payload_bytes,
+            }
+        return {
+            "profile": self.args.profile,
+            "settings": {
+                "bytes": self.args.bytes,
+                "size": self.args.size,
+                "count": self.args.count,
+                "interval": self.args.interval,
+                "connections": self.args.connections,
+                "proxy_args": self.args.proxy_args,
+                "sim_args": self.args.sim_args if self.args.auto == "sim" else None,
+            },
+            "complete": complete,
+            "intact": not any(f.corrupt for f in flows),
+            "elapsed": elapsed,
+            "payload_bytes": stats.payload_bytes,
+            "goodput": stats.payload_bytes / elapsed if elapsed > 0 else 0.0,
+            "messages": {"sent": stats.messages_sent, "delivered": len(latencies)},
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "airtime": {
+                "tx_seconds": {m.port: m.tx_seconds for m in monitors},
+                "utilisation": tx_seconds / elapsed if elapsed > 0 else 0.0,
+            },
+            "encoding_overhead": overhead,
+        }
+
+
+PROFILES = {
+    "bulk": benchmark.bulk,
+    "handshake": benchmark.handshake,
+    "pingpong": benchmark.pingpong,
+    "small": benchmark.small,
+    "concurrent": benchmark.concurrent,
+}
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, pct):
+    if not values:
+        return None
+    rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+# Time one fldigi spends transmitting, by polling its TRX status; the
+# simulator also counts what it sent, which gives the encoding overhead
+class airtime_monitor:
+    def __init__(self, port):
+        self.port = port
+        self.client = xmlrpc.client.ServerProxy(f"http://127.0.0.1:{port}/")
+        self.tx_seconds = 0.0
+        self.chars_sent = None
+        self.bits_sent = None
+        self.sim_start = None
+
+    async def xmlrpc(self, method, *args):
+        return await trio.to_thread.run_sync(method, *args, cancellable=True)
+
+    async def sim_stats(self):
+        try:
+            return await self.xmlrpc(self.client.sim.get_stats)
+        except xmlrpc.client.Fault:
+            return None
+
+    async def start(self):
+        self.sim_start = await self.sim_stats()
+
+    async def run(self):
+        last = trio.current_time()
+        while True:
+            state = await self.xmlrpc(self.client.main.get_trx_status)
+            now = trio.current_time()
+            if state.upper() == "TX":
+                self.tx_seconds += now - last
+            last = now
+            await trio.sleep(POLL_DELAY)
+
+    async def stop(self):
+        if self.sim_start is None:
+            return
+        sim_end = await self.sim_stats()
+        # the simulator's own figures are exact
+        self.tx_seconds = sim_end["tx_seconds"] - self.sim_start["tx_seconds"]
+        self.chars_sent = sim_end["chars_sent"] - self.sim_start["chars_sent"]
+        self.bits_sent = sim_end["bits_sent"] - self.sim_start["bits_sent"]
+
+
+# A bind probe, since connecting to a proxy's port would open a stream.
+# SO_REUSEADDR lets the bind succeed over connections lingering in TIME_WAIT
+# from an earlier run, so only a listener makes it fail.
+def port_listening(port):
+    with socket.socket() as probe:
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            probe.bind(("127.0.0.1", port))
+        except OSError:
+            return True
+    return False
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while not port_listening(port):
+        if time.time() > deadline:
+            raise TimeoutError(f"nothing listening on port {port}")
+        time.sleep(POLL_DELAY)
+
+
+# Start the simulator if asked, then a proxy for each end of the link
+def start_processes(args):
+    processes = []
+    output = subprocess.DEVNULL
+    if args.debug:
+        # stdout carries the JSON results, so the children log to stderr
+        output = sys.stderr
+    if args.auto == "sim":
+        command = [sys.executable, "fldigi_sim.py", "--xml"]
+        command += [str(port) for port in args.xml]
+        command += shlex.split(args.sim_args)
+        processes.append(subprocess.Popen(command, stdout=output, stderr=output))
+        for port in args.xml:
+            wait_for_port(port)
+    proxy_args = shlex.split(args.proxy_args)
+    ends = [("--proxy_out", args.inport), ("--proxy_in", args.outport)]
+    for xml_port, (mode, port) in zip(args.xml, ends):
+        command = [sys.executable, "fldigi_proxy.py", "--xml", str(xml_port)]
+        command += [mode, str(port)] + proxy_args
+        processes.append(subprocess.Popen(command, stdout=output, stderr=output))
+    wait_for_port(args.inport)
+    return processes
+
+
+async def main():
+    # fmt: off
+    parser = argparse.ArgumentParser(description="benchmark fldigi-proxy")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="handshake", help="traffic to send")
+    parser.add_argument("--inport", type=int, default=8822, help="port the sending proxy listens on with --proxy_out")
+    parser.add_argument("--outport", type=int, default=2288, help="port we listen on for the receiving proxy's --proxy_in")
+    parser.add_argument("--xml", type=int, nargs=2, default=[7362, 7363], help="XML-RPC ports of the sending and receiving fldigi")
+    parser.add_argument("--bytes", type=int, default=4096, help="bytes to send in the bulk profile")
+    parser.add_argument("--size", type=int, default=64, help="message size in bytes; pong size for pingpong")
+    parser.add_argument("--count", type=int, default=10, help="messages, round trips or handshakes to run")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between small messages")
+    parser.add_argument("--connections", type=int, default=4, help="connections for the concurrent profile")
+    parser.add_argument("--timeout", type=float, default=600.0, help="give up on the run after this many seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed for random payloads")
+    parser.add_argument("--auto", choices=["sim", "fldigi"], help="start both proxies, and the simulator with 'sim'; with 'fldigi' two fldigi instances must already be running")
+    parser.add_argument("--proxy_args", type=str, default="", help="extra arguments for both proxies with --auto")
+    parser.add_argument("--sim_args", type=str, default="", help="extra arguments for the simulator with --auto sim")
+    parser.add_argument("--output", type=str, help="write the JSON results here instead of stdout")
+    parser.add_argument("--debug", default=False, help="Add debug output, including the proxies'", action="store_true")
+    # fmt: on
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    results = await benchmark(args).run()
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    trio.run(main)
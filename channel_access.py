@@ -0,0 +1,154 @@
+"""
+Channel access schedulers, deciding when an fl_instance may transmit on the
+shared half-duplex radio channel
+"""
+
+import logging
+import random
+import time
+
+import trio
+
+import util
+
+logger = logging.getLogger("fldigi")
+
+
+# The original scheme: wait 10 s if we sent last or 5 s if we received last,
+# and until nothing has been heard for that long
+class fixed_delay_access:
+    def __init__(self, fl_digi):
+        self.fl_digi = fl_digi
+
+    async def wait_for_turn(self):
+        # If we last sent, sleep longer to be polite!
+        if self.fl_digi.last_send > self.fl_digi.last_recv:
+            delay = 10
+            logger.debug(f"Waiting {delay}s before send as we sent last")
+        else:
+            delay = 5
+            logger.debug(f"Waiting {delay}s before send as we received last")
+        await trio.sleep(delay)
+        # Make sure we didn't start receiving while we were sleeping
+        while self.fl_digi.last_recv + delay > time.time():
+            await trio.sleep(self.fl_digi.poll_delay)
+
+    def frame_sent(self):
+        pass
+
+    def frame_received(self, flags):
+        pass
+
+    def frame_failed(self):
+        pass
+
+
+# Explicit turn passing: the last frame of every transmission carries
+# util.FLAG_TURN, and the station receiving it may transmit as soon as the
+# sender's transmitter is off. A turn not used within turn_timeout lapses and
+# the channel is free; a station then transmits once the channel sounds idle.
+# Random backoff is only used after a collision: a transmission on a free
+# channel that was answered only by a frame we couldn't decode. A peer that
+# stays silent just had nothing to send.
+class turn_passing_access:
+    # time for the peer's transmitter to key down before we key up
+    guard_time = 0.5
+    turn_timeout = 3.0
+    contention_window = 1.0
+    max_backoff_exponent = 3
+
+    def __init__(self, fl_digi):
+        self.fl_digi = fl_digi
+        self.have_turn = False
+        # when a frame last ended on the channel, sent or received
+        self.last_activity = 0.0
+        # we took a free channel and have heard nothing since
+        self.awaiting_reply = False
+        # a frame failed to decode while we awaited a reply
+        self.garbled = False
+        self.collisions = 0
+        self.squelch = None
+        self.squelch_level = None
+
+    # Carrier sense: a frame part-way through decoding, fresh RX text, or a
+    # signal above fldigi's squelch level all mean someone is transmitting.
+    # A frame whose suffix never arrives stops counting once the longest
+    # frame would have ended, so a lost suffix can't hold the channel forever.
+    async def channel_busy(self):
+        rx_decoder = self.fl_digi.rx_decoder
+        if rx_decoder.in_frame:
+            frame_seconds = time.time() - rx_decoder.frame_started
+            if frame_seconds < self.fl_digi.max_frame_seconds():
+                return True
+        if time.time() - self.fl_digi.last_recv < self.guard_time:
+            return True
+        fl_client = self.fl_digi.fl_client
+        if self.squelch is None:
+            self.squelch = await self.fl_digi.xmlrpc(
+                lambda: fl_client.main.squelch, name="get_squelch"
+            )
+            self.squelch_level = await self.fl_digi.xmlrpc(
+                lambda: fl_client.main.squelch_level, name="get_squelch_level"
+            )
+        if not self.squelch:
+            return False
+        quality = await self.fl_digi.xmlrpc(
+            lambda: fl_client.modem.quality, name="get_quality"
+        )
+        return quality > self.squelch_level
+
+    async def wait_for_turn(self):
+        while True:
+            now = time.time()
+            turn_lapsed = now - self.last_activity > self.turn_timeout
+            if self.have_turn and not turn_lapsed:
+                guard_end = self.fl_digi.last_recv + self.guard_time
+                await trio.sleep(max(guard_end - now, 0))
+                # The peer may still be keyed up, streaming more frames after
+                # the one that passed the turn or idling before it keys down
+                if await self.channel_busy():
+                    continue
+                logger.debug("Sending as the peer passed us the turn")
+                return
+            if turn_lapsed and self.awaiting_reply:
+                self.awaiting_reply = False
+                if self.garbled:
+                    self.collisions = min(self.collisions + 1, self.max_backoff_exponent)
+                    logger.debug(f"Garbled reply on a free channel, collisions {self.collisions}")
+                else:
+                    self.collisions = 0
+            if turn_lapsed and not await self.channel_busy():
+                if self.collisions:
+                    window = self.contention_window * 2 ** self.collisions
+                    backoff = random.uniform(0, window)
+                    logger.debug(f"Backing off {backoff:.2f}s before taking the channel")
+                    await trio.sleep(backoff)
+                    if self.fl_digi.last_recv > now or await self.channel_busy():
+                        continue
+                logger.debug("Sending on a free channel")
+                self.awaiting_reply = True
+                return
+            await trio.sleep(self.fl_digi.poll_delay)
+
+    def frame_sent(self):
+        self.have_turn = False
+        self.garbled = False
+        self.last_activity = time.time()
+
+    def frame_received(self, flags):
+        self.last_activity = time.time()
+        self.awaiting_reply = False
+        self.collisions = 0
+        self.have_turn = bool(flags & util.FLAG_TURN)
+
+    # A frame failed its CRC or lost its suffix
+    def frame_failed(self):
+        self.last_activity = time.time()
+        if self.awaiting_reply:
+            self.garbled = True
+
+
+CHANNEL_ACCESS = {
+    "fixed": fixed_delay_access,
+    "turn": turn_passing_access,
+}
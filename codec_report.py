@@ -0,0 +1,47 @@
+#!/usr/bin/env python3.8
+
+"""
+Report how many bits each payload codec puts on air per payload byte,
+using PSK varicode costs
+"""
+
+import argparse
+import os
+
+import util
+
+
+def codec_cost(codec, payloads):
+    raw_bytes = sum(len(payload) for payload in payloads)
+    frames = [util.encode_frame(payload, codec.name) for payload in payloads]
+    chars = sum(len(frame) for frame in frames)
+    bits = sum(util.varicode_bits(frame) for frame in frames)
+    return chars / raw_bytes, bits / raw_bytes
+
+
+def main():
+    # fmt: off
+    parser = argparse.ArgumentParser(description="compare fldigi-proxy payload codecs")
+    parser.add_argument("--random", type=int, default=4096, help="bytes of random payload to add to the sample")
+    parser.add_argument("--size", type=int, default=256, help="payload size in bytes for random frames")
+    # fmt: on
+    args = parser.parse_args()
+
+    samples = {"handshakes": util.test_raw_handshakes()}
+    if args.random > 0:
+        random_data = os.urandom(args.random)
+        samples["random"] = [
+            random_data[i : i + args.size]
+            for i in range(0, len(random_data), args.size)
+        ]
+
+    for sample, payloads in samples.items():
+        print(f"{sample}: {len(payloads)} frames, framing included")
+        print(f"  {'codec':<10} {'chars/byte':>10} {'bits/byte':>10}")
+        for codec in util.CODECS.values():
+            chars_per_byte, bits_per_byte = codec_cost(codec, payloads)
+            print(f"  {codec.name:<10} {chars_per_byte:>10.3f} {bits_per_byte:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
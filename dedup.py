@@ -0,0 +1,132 @@
+"""
+Content-addressed dedup of port data across the radio link: both ends keep
+an LRU cache of recent segments keyed by a short hash, and a segment the
+peer already holds goes out as a reference to its key instead of in full
+"""
+
+import collections
+import hashlib
+import logging
+
+import metrics
+
+logger = logging.getLogger("fldigi")
+
+KEY_BYTES = 4
+# Segments shorter than this go out in full: a reference saves too little
+MIN_SEGMENT = 16
+# The tag byte starting each segment of a frame from a deduplicating sender
+TAG_LITERAL = 0
+TAG_INSERT = 1
+TAG_REFERENCE = 2
+
+lookups_hit = metrics.counter_metric(
+    "dedup_lookups_total", "Segments looked up in the dedup cache", result="hit"
+)
+lookups_miss = metrics.counter_metric(
+    "dedup_lookups_total", "Segments looked up in the dedup cache", result="miss"
+)
+bytes_saved = metrics.counter_metric(
+    "dedup_bytes_saved_total", "Bytes of port data sent as references"
+)
+unresolved = metrics.counter_metric(
+    "dedup_unresolved_total", "References to segments missing from the cache"
+)
+
+
+def segment_key(segment):
+    return hashlib.blake2b(segment, digest_size=KEY_BYTES).digest()
+
+
+# An LRU cache of segments holding at most capacity bytes of them.
+# The sender tags the segments that are to be cached, and both ends apply the
+# same inserts and touches in the same order: the sender as it takes segments
+# for new frames, the receiver as ARQ delivers those frames in order. Their
+# caches, and what each evicts, stay identical without any cache traffic.
+# That needs ARQ, which delivers every frame exactly once and in order.
+class dedup_cache:
+    # side is "send" or "receive", labelling the cache's metrics
+    def __init__(self, capacity=65536, side="send"):
+        self.capacity = capacity
+        self.cache_bytes = metrics.gauge_metric(
+            "dedup_cache_bytes", "Bytes of port data held in a dedup cache", side=side
+        )
+        # key -> segment, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def insert(self, key, segment):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = segment
+        self.size += len(segment)
+        while self.size > self.capacity:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+        self.cache_bytes.set(self.size)
+
+    def touch(self, key):
+        segment = self.entries.get(key)
+        if segment is not None:
+            self.entries.move_to_end(key)
+        return segment
+
+    # Tag the segments of a new frame, replacing those the peer holds with
+    # references and caching the ones worth keeping
+    def encode(self, segments):
+        tagged = []
+        for segment in segments:
+            if not MIN_SEGMENT <= len(segment) <= self.capacity:
+                tagged.append(bytes([TAG_LITERAL]) + segment)
+                continue
+            key = segment_key(segment)
+            # a hash collision replaces the old segment at both ends
+            if self.entries.get(key) == segment:
+                self.touch(key)
+                lookups_hit.inc()
+                bytes_saved.inc(len(segment) - KEY_BYTES)
+                tagged.append(bytes([TAG_REFERENCE]) + key)
+                continue
+            lookups_miss.inc()
+            self.insert(key, segment)
+            tagged.append(bytes([TAG_INSERT]) + segment)
+        return tagged
+
+    # Retag the segments of a frame encode() tagged as literals, for a peer
+    # whose cache is gone. A reference evicted since stays as it is, and the
+    # peer will report it unresolved.
+    def literal(self, tagged):
+        segments = []
+        for item in tagged:
+            tag, body = item[0], item[1:]
+            if tag == TAG_REFERENCE:
+                body = self.entries.get(body)
+                if body is None:
+                    segments.append(item)
+                    continue
+            segments.append(bytes([TAG_LITERAL]) + body)
+        return segments
+
+    # Inverse of encode, for the segments of a frame delivered in order
+    # raises ValueError for a malformed segment or one the cache lacks
+    def decode(self, tagged):
+        segments = []
+        for item in tagged:
+            if not item:
+                raise ValueError("dedup segment without a tag")
+            tag, body = item[0], item[1:]
+            if tag == TAG_LITERAL:
+                segments.append(body)
+            elif tag == TAG_INSERT:
+                self.insert(segment_key(body), body)
+                segments.append(body)
+            elif tag == TAG_REFERENCE and len(body) == KEY_BYTES:
+                segment = self.touch(body)
+                if segment is None:
+                    unresolved.inc()
+                    raise ValueError(f"dedup reference {body.hex()} not in cache")
+                segments.append(segment)
+            else:
+                raise ValueError(f"bad dedup segment tag {tag}")
+        return segments
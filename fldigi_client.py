@@ -4,15 +4,68 @@ fl_instance used to interface with fldigi via pyfldigi and the fldigi XML-RPC se
 
 import logging
 import time
-from collections import deque
+from functools import partial
 
 import pyfldigi
 import trio
 
+import airtime
+import metrics
+import util
+from arq import selective_repeat
+from channel_access import CHANNEL_ACCESS
+from dedup import dedup_cache
+from radio_trace import KIND_RX, KIND_TX, trace_writer
+from rate_adapt import rate_controller
+from spool import frame_spool
+from stream_mux import stream_multiplexer
+
 logger = logging.getLogger("fldigi")
 _client_logger = logging.getLogger("pyfldigi.client.text")
 _client_logger.setLevel(logging.INFO)
 
+encode_time = metrics.histogram_metric(
+    "encode_seconds", "Time to pack and encode the frames of one transmission"
+)
+decode_time = metrics.histogram_metric("decode_seconds", "Time to decode one frame")
+turn_wait = metrics.histogram_metric(
+    "turn_wait_seconds", "Time from having data to send to being allowed to send it"
+)
+tx_airtime = metrics.histogram_metric(
+    "tx_airtime_seconds", "Time from handing a transmission to fldigi to the end of it"
+)
+frame_latency = metrics.histogram_metric(
+    "frame_latency_seconds",
+    "Time from reading the oldest port data in a transmission to the end of it",
+)
+tx_frames = metrics.counter_metric("tx_frames_total", "Frames transmitted")
+tx_chars = metrics.counter_metric("tx_chars_total", "Characters handed to fldigi")
+rx_chars = metrics.counter_metric("rx_chars_total", "Characters read from fldigi")
+rx_frames_ok = metrics.counter_metric("rx_frames_total", "Frames received", result="ok")
+rx_frames_dropped = metrics.counter_metric(
+    "rx_frames_total", "Frames received", result="dropped"
+)
+fec_repaired = metrics.counter_metric(
+    "fec_repaired_bytes_total", "Bytes repaired by Reed-Solomon FEC"
+)
+
+# The fldigi settings we keep a copy of, with the XML-RPC methods that read
+# and write each one
+# fmt: off
+SETTINGS = {
+    "version":         ("fldigi.version_struct", None),
+    "rig.bandwidth":   ("rig.get_bandwidth",     "rig.set_bandwidth"),
+    "rig.frequency":   ("rig.get_frequency",     "rig.set_frequency"),
+    "rig.mode":        ("rig.get_mode",          "rig.set_mode"),
+    "rig.name":        ("rig.get_name",          "rig.set_name"),
+    "modem.names":     ("modem.get_names",       None),
+    "modem.name":      ("modem.get_name",        "modem.set_by_name"),
+    "modem.bandwidth": ("modem.get_bandwidth",   "modem.set_bandwidth"),
+    "modem.carrier":   ("modem.get_carrier",     "modem.set_carrier"),
+    "main.afc":        ("main.get_afc",          "main.set_afc"),
+}
+# fmt: on
+
 
 class fl_instance:
     # default ports: 7322 for ARQ, 7342 for TCP/IP, 7362 for XML, 8421 for fllog
@@ -21,15 +74,60 @@ class fl_instance:
     proxy_port = 22
     # Mirror poll delay from pyfldigi.Client.TxMonitor
     poll_delay = 0.25
-    send_timeout_multiplier = 0.0
-    modem_timeout_multipliers = {
-        "BPSK63": 1.0,
-        "PSK125R": 0.5,
-        "PSK250R": 0.25,
-        "PSK500R": 0.125,
-    }
-    base64_prefix = b"BTC"
-    base64_suffix = b"\r\n"
+    # fldigi's RX text is polled every poll_delay, slowing to rx_idle_delay
+    # while we transmit or once nothing has been heard or sent for
+    # rx_idle_after seconds. Within poll_delay of the end of a frame, going by
+    # the length in its header, the next poll is timed for the end, but no
+    # sooner than rx_min_delay, so its suffix is read about as soon as it
+    # arrives.
+    rx_idle_delay = 1.0
+    rx_idle_after = 10.0
+    rx_min_delay = 0.05
+    # Airtime figures for the modem fldigi is using
+    modem_timing = airtime.MODEMS[airtime.DEFAULT_MODEM]
+    # A transmission times out after its airtime times the margin, plus the
+    # TX monitor's tail and the slack
+    send_timeout_margin = 1.25
+    send_timeout_slack = 5.0
+    # Port data is gathered into one transmission of up to batch_bytes of
+    # payload and batch_airtime seconds, waiting at most batch_delay for more
+    batch_bytes = 4096
+    batch_airtime = 60.0
+    batch_delay = 0.5
+    frame_prefix = util.FRAME_PREFIX
+    frame_suffix = util.FRAME_SUFFIX
+    codec = "varicode"
+    use_compression = True
+    access = "turn"
+    # Reed-Solomon parity bytes per block in frames we send; 0 sends a CRC only
+    fec = 0
+    # Selective-repeat ARQ window in frames; None turns ARQ off
+    arq_window = None
+    # With ARQ, port data is split into frames of at most this many seconds
+    # on air, so a lost frame costs little to send again. The default window
+    # of 4 such frames fills batch_airtime.
+    arq_frame_airtime = 15.0
+    # Step the modem up and down with link quality, agreed with the peer
+    adapt_rate = False
+    # Weight of each new measurement in measured_rate
+    rate_smoothing = 0.3
+    # Keep appending transmissions to fldigi's TX buffer while there is work,
+    # as one burst, instead of keying down after each
+    stream_tx = False
+    # The next transmission of a burst is put together once the text still to
+    # go out would take less than stream_lead seconds, so late data joins it.
+    # A burst ends after burst_airtime seconds so the peer gets a turn.
+    stream_lead = 2.0
+    burst_airtime = 120.0
+    # Bytes of recent port data each end caches so repeats go out as
+    # references; None turns dedup off. Needs ARQ.
+    dedup_bytes = None
+    # File keeping the frames ARQ has in flight across restarts; None keeps
+    # them in memory only
+    spool_path = None
+    # File to record RX fragments and TX buffers to, for replay.py; None
+    # records nothing
+    trace_path = None
 
     # we assume no port collisions for KISS, ARQ, or XMLRPC ports
     # TODO: check ports before starting
@@ -40,19 +138,75 @@ class fl_instance:
             xml_port=xml_port,
             proxy_in=None,
             proxy_out=None,
+            codec=codec,
+            use_compression=use_compression,
+            batch_bytes=batch_bytes,
+            batch_airtime=batch_airtime,
+            access=access,
+            fec=fec,
+            arq_window=arq_window,
+            adapt_rate=adapt_rate,
+            stream_tx=stream_tx,
+            dedup_bytes=dedup_bytes,
+            spool_path=spool_path,
+            trace_path=trace_path,
+            connect=True,
     ):
         self.host_ip = host
+        if codec is not None:
+            self.codec = codec
+        self.use_compression = use_compression
+        if batch_bytes is not None:
+            self.batch_bytes = batch_bytes
+        if batch_airtime is not None:
+            self.batch_airtime = batch_airtime
         if xml_port is not None:
             self.xml_port = xml_port
         if not no_proxy:
             self.proxy_in = proxy_in
             self.proxy_out = proxy_out
-        self.fl_client = pyfldigi.Client(hostname=self.host_ip, port=self.xml_port)
-        self.fl_app = pyfldigi.ApplicationMonitor(
-            hostname=self.host_ip, port=self.xml_port
-        )
+        # connect=False leaves out fldigi altogether, for replay.py to drive
+        # the receive pipeline offline
+        self.fl_client = self.fl_app = None
+        if connect:
+            self.fl_client = pyfldigi.Client(hostname=self.host_ip, port=self.xml_port)
+            self.fl_app = pyfldigi.ApplicationMonitor(
+                hostname=self.host_ip, port=self.xml_port
+            )
         self.last_recv = time.time()
         self.last_send = time.time()
+        self.rx_decoder = util.frame_decoder(self.frame_prefix, self.frame_suffix)
+        if access is not None:
+            self.access = access
+        if fec is not None:
+            self.fec = fec
+        self.arq = None
+        if arq_window:
+            spool = frame_spool(spool_path) if spool_path else None
+            self.arq = selective_repeat(arq_window, spool)
+        self.rate = None
+        if adapt_rate:
+            self.rate = rate_controller(self)
+        self.stream_tx = stream_tx
+        self.dedup_tx = self.dedup_rx = None
+        if dedup_bytes:
+            if self.arq is None:
+                raise ValueError("dedup needs ARQ")
+            self.dedup_tx = dedup_cache(dedup_bytes, side="send")
+            self.dedup_rx = dedup_cache(dedup_bytes, side="receive")
+        self.channel_access = CHANNEL_ACCESS[self.access](self)
+        self.mux = stream_multiplexer()
+        # set by link_bond.bonded_link when this is one of several bonded links
+        self.bond = None
+        self.sending = False
+        # port data bytes per second of transmission, once we have sent some
+        self.measured_rate = None
+        # set to cut an idle RX poll short, when a reply may be on its way
+        self.rx_wake = trio.Event()
+        # fldigi's SETTINGS as we last read or wrote them; nothing else
+        # changes them, so we never read them back
+        self.settings = {}
+        self.trace = trace_writer(trace_path) if trace_path else None
 
     def port_info(self):
         logger.info(
@@ -63,129 +217,473 @@ class fl_instance:
         )
 
     def version(self):
-        return self.fl_client.version
+        return self.settings["version"]
+
+    # Write settings, then read others, in one system.multicall round trip.
+    # writes are (setting, value) pairs, applied in order; a write fldigi
+    # refuses is logged and leaves the cached value alone.
+    def apply(self, writes=(), reads=()):
+        calls = [
+            {"methodName": SETTINGS[setting][1], "params": [value]}
+            for setting, value in writes
+        ]
+        calls += [{"methodName": SETTINGS[setting][0], "params": []} for setting in reads]
+        if not calls:
+            return
+        results = self.fl_client.client.system.multicall(calls)
+        for (setting, value), result in zip(writes, results):
+            if isinstance(result, dict):
+                logger.warning(f"fldigi refused {setting} = {value}: {result['faultString']}")
+            else:
+                self.settings[setting] = value
+        for setting, result in zip(reads, results[len(writes) :]):
+            if isinstance(result, dict):
+                logger.warning(f"could not read {setting}: {result['faultString']}")
+            else:
+                self.settings[setting] = result[0]
+
+    # Apply writes and read every setting back, at startup
+    def configure(self, writes=()):
+        self.apply(writes, list(SETTINGS))
+
+    # pyfldigi is synchronous, and a blocking XML-RPC round-trip would stall every
+    # other trio task; run each call in a worker thread instead.
+    # pyfldigi's transport makes a fresh HTTP request per call, so calls from
+    # several threads at once are safe.
+    # name labels the call's latency metric, for funcs without a useful __name__
+    async def xmlrpc(self, func, *args, name=None):
+        method = name or getattr(func, "__name__", "call")
+        call_time = metrics.histogram_metric(
+            "xmlrpc_seconds", "XML-RPC round-trip time", method=method
+        )
+        with call_time.time():
+            return await trio.to_thread.run_sync(partial(func, *args), cancellable=True)
+
+    async def clear_buffers(self):
+        await self.xmlrpc(self.fl_client.text.clear_rx)
+        await self.xmlrpc(self.fl_client.text.clear_tx)
+
+    async def abort(self):
+        await self.xmlrpc(self.fl_client.main.abort)
+
+    async def rx(self):
+        await self.xmlrpc(self.fl_client.main.rx)
+
+    # Hand data to fldigi without blocking, then wait for the TX monitor thread
+    # of pyfldigi to report the end of the transmission.
+    # main.send(block=True) would busy-wait on that same flag in our worker thread.
+    async def send(self, data, timeout):
+        await self.xmlrpc(self.fl_client.main.send, data, False, timeout)
+        with trio.move_on_after(timeout):
+            while True:
+                await trio.sleep(self.poll_delay)
+                if not self.fl_client.txmonitor.transmitting:
+                    return
+        raise TimeoutError(
+            "Timeout while transmitting, waiting for text to be transmitted"
+        )
+
+    # Characters of the current transmission that fldigi has sent so far, as
+    # pyfldigi's TX monitor thread saw them go; main.send clears its history
+    # when it keys up
+    def tx_chars_sent(self):
+        history = self.fl_client.txmonitor.history.txdata_history
+        return sum(len(tx_data.data) for tx_data in list(history))
+
+    # Send radio_buffer, then keep appending transmissions to fldigi's TX
+    # buffer while there is work and the burst is short enough, and return
+    # once all of it has gone out
+    # returns the text, ARQ seqs and bytes of port data of the whole burst,
+    # and when the oldest port data in each transmission was queued
+    async def send_burst(self, radio_buffer, seqs, data_bytes, queued_at):
+        burst = radio_buffer
+        await self.xmlrpc(
+            self.fl_client.main.send, radio_buffer, False, self.send_timeout(burst)
+        )
+        # frames are on their way, so don't take them as due again before
+        # their airtime is over
+        if self.arq is not None:
+            air_end = trio.current_time() + self.modem_timing.text_seconds(burst)
+            self.arq.frames_sent(seqs, air_end)
+        start = trio.current_time()
+        while True:
+            await trio.sleep(self.poll_delay)
+            sent = self.tx_chars_sent()
+            remaining = self.modem_timing.text_seconds(burst[sent:])
+            burst_seconds = self.modem_timing.text_seconds(burst)
+            if (
+                remaining < self.stream_lead
+                and burst_seconds < self.burst_airtime
+                and self.has_work()
+            ):
+                more, more_seqs, more_bytes = await self.next_transmission()
+                if more:
+                    await self.xmlrpc(self.fl_client.text.add_tx, more)
+                    if self.arq is not None:
+                        queued = self.modem_timing.text_seconds(burst[sent:] + more)
+                        self.arq.frames_sent(more_seqs, trio.current_time() + queued)
+                    burst += more
+                    seqs += more_seqs
+                    data_bytes += more_bytes
+                    queued_at.append(self.mux.last_queued_at)
+                    self.mux.last_queued_at = None
+                    continue
+            if sent >= len(burst):
+                break
+            if trio.current_time() - start > self.send_timeout(burst):
+                raise TimeoutError(
+                    "Timeout while transmitting, waiting for text to be transmitted"
+                )
+        # the last character is still on air, then the postamble
+        last_char = self.modem_timing.text_seconds(burst[-1:])
+        await trio.sleep(last_char + self.modem_timing.postamble)
+        return burst, seqs, data_bytes, queued_at
+
+    # Whether there is anything to transmit now
+    def has_work(self):
+        if self.mux.has_data() and (self.arq is None or self.arq.window_open()):
+            return True
+        if self.arq is not None and self.arq.has_work():
+            return True
+        return self.rate is not None and self.rate.has_work()
+
+    # Upper bound on the airtime a segment adds to a batch, ignoring compression
+    def segment_airtime(self, segment):
+        text = util.CODECS[self.codec].encode(segment)
+        return self.modem_timing.text_seconds(text)
+
+    # How long to wait for radio_buffer to go out before giving up on it
+    def send_timeout(self, radio_buffer):
+        seconds = self.modem_timing.transmission_seconds(radio_buffer)
+        return (
+            seconds * self.send_timeout_margin
+            + airtime.TX_MONITOR_TAIL
+            + self.send_timeout_slack
+        )
 
-    def clear_buffers(self):
-        self.fl_client.text.clear_rx()
-        self.fl_client.text.clear_tx()
+    # The longest a frame we receive can stay on the air: a whole batch, with
+    # the same margin a transmission gets
+    def max_frame_seconds(self):
+        return self.batch_airtime * self.send_timeout_margin + airtime.TX_MONITOR_TAIL
 
-    async def radio_send_task(self, packet_deque: deque):
+    # Port data bytes per second we expect to carry: measured once we have
+    # sent something, and from the modem's bitrate until then
+    def expected_rate(self):
+        if self.measured_rate is not None:
+            return self.measured_rate
+        return self.modem_timing.bitrate / 8
+
+    def measure_rate(self, data_bytes, seconds):
+        # acks and rate control alone say nothing about the data rate
+        if data_bytes == 0 or seconds <= 0:
+            return
+        rate = data_bytes / seconds
+        if self.measured_rate is None:
+            self.measured_rate = rate
+        else:
+            self.measured_rate += self.rate_smoothing * (rate - self.measured_rate)
+
+    # Give port data batch_delay to gather, then take frames for up to the
+    # batch budget from the streams in turn. A bonded link only takes its
+    # share of the data, leaving the rest for the other links.
+    async def next_batch(self, max_frames=None):
+        with trio.move_on_after(self.batch_delay):
+            while self.mux.queued_bytes() < self.batch_bytes:
+                await self.mux.wait_for_update()
+        max_bytes = self.batch_bytes
+        if self.bond is not None:
+            max_bytes = min(max_bytes, self.bond.share(self))
+        max_frame_airtime = None
+        if self.arq is not None:
+            max_frame_airtime = self.arq_frame_airtime
+        return self.mux.take(
+            max_bytes,
+            self.batch_airtime,
+            self.segment_airtime,
+            max_frames,
+            max_frame_airtime,
+        )
+
+    # Wait for port data, an ack or retransmission to be due in ARQ mode, or
+    # an answer owed to a modem rate proposal
+    async def wait_for_work(self):
+        waiters = [self.mux.wait_for_data]
+        if self.arq is not None:
+            waiters.append(self.arq.wait_for_work)
+        if self.rate is not None:
+            waiters.append(self.rate.wait_for_work)
+        async with trio.open_nursery() as nursery:
+
+            async def wake(waiter):
+                await waiter()
+                nursery.cancel_scope.cancel()
+
+            for waiter in waiters:
+                nursery.start_soon(wake, waiter)
+
+    # Frames for one transmission: ARQ retransmissions first, then new frames
+    # of port data while the ARQ window allows, else an ack or rate control
+    # frame. The last frame carries any rate control byte.
+    # returns the encoded frames, their ARQ seqs, and the bytes of port data
+    async def next_transmission(self):
+        frames = []
+        max_frames = None
+        if self.arq is not None:
+            frames = self.arq.due_frames()
+            max_frames = self.arq.window_space()
+        if self.mux.has_data() and (max_frames is None or max_frames > 0):
+            for frame in await self.next_batch(max_frames):
+                # retransmissions resend the same tags, so dedup new frames
+                # only, in the order ARQ numbers them
+                if self.dedup_tx is not None:
+                    stream_id, segments, fin, stream_seq = frame
+                    segments = self.dedup_tx.encode(segments)
+                    frame = (stream_id, segments, fin, stream_seq)
+                seq = self.arq.add(frame) if self.arq is not None else None
+                frames.append((seq, frame))
+        rate_control = self.rate.control() if self.rate is not None else None
+        ack_pending = self.arq is not None and self.arq.ack_pending
+        if not frames and (ack_pending or rate_control is not None):
+            frames.append((None, (None, [], False, None)))
+        radio_buffer = b""
+        data_bytes = 0
+        encode_start = time.perf_counter()
+        for i, (seq, (stream_id, segments, fin, stream_seq)) in enumerate(frames):
+            data_bytes += sum(len(segment) for segment in segments)
+            # The last frame passes the turn
+            flags = util.FLAG_TURN if i == len(frames) - 1 else 0
+            if fin:
+                flags |= util.FLAG_FIN
+            if self.arq is not None:
+                header = self.arq.header(flags, seq, stream_id)
+            else:
+                header = util.frame_header(flags, stream=stream_id)
+            header.stream_seq = stream_seq
+            header.dedup = self.dedup_tx is not None
+            if i == len(frames) - 1:
+                header.rate = rate_control
+            payload = util.pack_payload(segments, self.use_compression, header)
+            radio_buffer += util.encode_frame(payload, self.codec, self.fec)
+        encode_time.observe(time.perf_counter() - encode_start)
+        if self.trace is not None and radio_buffer:
+            self.trace.write(KIND_TX, radio_buffer)
+        # the frames must outlive a crash before the peer can hear them
+        await self.commit_spool()
+        return radio_buffer, [seq for seq, _ in frames], data_bytes
+
+    # The one TX scheduler for every stream on this radio
+    async def radio_send_task(self):
         logger.debug("started radio_send_task")
         while True:
+            if not self.mux.has_data():
+                await self.wait_for_work()
+            elif self.arq is not None:
+                await self.arq.wait_for_window()
+            # Anything queued while we wait for our turn joins the batch
+            with turn_wait.time():
+                await self.channel_access.wait_for_turn()
+            radio_buffer, seqs, data_bytes = await self.next_transmission()
+            if not radio_buffer:
+                continue
+            queued_at = [self.mux.last_queued_at]
+            self.mux.last_queued_at = None
+
+            self.sending = True
+            send_start = trio.current_time()
             try:
-                radio_buffer = packet_deque.popleft()
-            # Nothing in the deque
-            except IndexError:
-                await trio.sleep(self.poll_delay)
-            # Got something to send
-            else:
-                # Some sleeps to try and avoid transmitting at same time
-                # If we last sent, sleep longer to be polite!
-                if self.last_send > self.last_recv:
-                    delay = 10
-                    logger.debug(f"Waiting {delay}s before send as we sent last")
+                if self.stream_tx:
+                    radio_buffer, seqs, data_bytes, queued_at = await self.send_burst(
+                        radio_buffer, seqs, data_bytes, queued_at
+                    )
                 else:
-                    delay = 5
-                    logger.debug(f"Waiting {delay}s before send as we received last")
-                await trio.sleep(delay)
-                # Make sure we didn't start receiving while we were sleeping
-                while self.last_recv + delay > time.time():
-                    await trio.sleep(self.poll_delay)
-
-                logger.info(f"Sending: {radio_buffer}")
-                # We actually use a long timeout because we might be receiving which
-                # blocks too
-                msg_timeout = len(radio_buffer) * self.send_timeout_multiplier
-                try:
-                    self.fl_client.main.send(radio_buffer, True, msg_timeout)
-                except TimeoutError as e:
-                    # Try to continue
-                    logger.exception(e)
-                logger.info(f"Sent: {radio_buffer}")
-                self.last_send = time.time()
-                self.fl_client.main.abort()
-                self.fl_client.main.rx()
+                    await self.send(radio_buffer, self.send_timeout(radio_buffer))
+            except TimeoutError as e:
+                # Try to continue
+                logger.exception(e)
+            finally:
+                self.sending = False
+            send_end = trio.current_time()
+            self.measure_rate(data_bytes, send_end - send_start)
+            tx_airtime.observe(send_end - send_start)
+            tx_frames.inc(len(seqs))
+            tx_chars.inc(len(radio_buffer))
+            for oldest in queued_at:
+                if oldest is not None:
+                    frame_latency.observe(send_end - oldest)
+            self.last_send = time.time()
+            if self.arq is not None:
+                self.arq.frames_sent(seqs)
+            self.channel_access.frame_sent()
+            await self.abort()
+            await self.rx()
+            # the peer may answer straight away
+            self.rx_wake.set()
+            if self.rate is not None:
+                await self.rate.transmission_sent()
+
+    # How long until fldigi's RX text is worth reading again
+    def rx_poll_delay(self):
+        # fldigi hears nothing while we transmit
+        if self.sending:
+            return self.rx_idle_delay
+        remaining = self.rx_decoder.remaining_chars()
+        if remaining is not None:
+            frame_delay = self.modem_timing.chars_seconds(remaining)
+            # a frame more than poll_delay overdue has lost its suffix
+            if -self.poll_delay < frame_delay < self.poll_delay:
+                return max(frame_delay, self.rx_min_delay)
+        quiet = time.time() - max(self.last_recv, self.last_send)
+        if quiet > self.rx_idle_after:
+            return self.rx_idle_delay
+        return self.poll_delay
 
     async def get_fragment(self):
-        await trio.sleep(self.poll_delay)
-        fragment = self.fl_client.text.get_rx_data()
-        if isinstance(fragment, bytes) and fragment is not b"":
-            logger.info(f"Got fragment: {fragment}")
+        with trio.move_on_after(self.rx_poll_delay()):
+            await self.rx_wake.wait()
+        if self.rx_wake.is_set():
+            self.rx_wake = trio.Event()
+        fragment = await self.xmlrpc(self.fl_client.text.get_rx_data)
+        if isinstance(fragment, bytes) and fragment != b"":
+            if self.trace is not None:
+                self.trace.write(KIND_RX, fragment)
+            rx_chars.inc(len(fragment))
             self.last_recv = time.time()
             return fragment.replace(b" ", b"")
         else:
             return b""
 
     # received content is raw bytes, newline-terminated
+    # returns every complete frame decoded so far; partial frames carry over
+    # to the next poll
     async def radio_receive(self):
-        rx_msg = bytes()
-        rx_msg += await self.get_fragment()
-        # Didn't get anything
-        if rx_msg is b"":
-            return rx_msg
-        else:
-            while True:
-                rx_msg += await self.get_fragment()
-                # We've hit or gone past the end of one message.
-                # TODO: Extra bytes currently discarded
-                if self.base64_suffix in rx_msg:
-                    break
-        self.fl_client.text.clear_rx()
-        # Cleanup the message
-        try:
-            _start = rx_msg.index(self.base64_prefix)
-            _end = rx_msg.index(self.base64_suffix)
-        except ValueError:
-            logger.exception("in radio_receive")
-            return None
-        return rx_msg[len(self.base64_prefix) + _start : _end]
-
-    async def radio_receive_task(self, packet_deque: deque):
+        cut_frames = self.rx_decoder.cut_frames
+        frames = self.rx_decoder.feed(await self.get_fragment())
+        if self.rx_decoder.cut_frames > cut_frames:
+            logger.warning("dropping frame: its suffix was lost")
+            rx_frames_dropped.inc(self.rx_decoder.cut_frames - cut_frames)
+            self.channel_access.frame_failed()
+        return frames
+
+    # The one RX demultiplexer for every stream on this radio
+    async def radio_receive_task(self):
         logger.debug("started radio_receive_task")
         while True:
-            await trio.sleep(self.poll_delay)
-            radio_buffer = await self.radio_receive()
-            if radio_buffer:
-                logger.info(f"Received: {radio_buffer}")
-                packet_deque.append(radio_buffer)
+            if self.rate is not None:
+                await self.rate.check_link()
+            await self.mux.check_gaps()
+            for radio_buffer in await self.radio_receive():
+                await self.frame_received(radio_buffer)
+            await self.commit_spool()
+
+    # fsync the ARQ spool once for everything a transmission or a batch of
+    # received frames appended to it
+    async def commit_spool(self):
+        if self.arq is not None and self.arq.spool is not None:
+            await self.arq.spool.commit()
+
+    # Decode one frame from the radio and hand its data to its stream
+    # returns False if the frame was dropped
+    async def frame_received(self, radio_buffer):
+        try:
+            with decode_time.time():
+                payload, corrected = util.decode_frame(radio_buffer)
+                header, segments = util.unpack_payload(payload)
+        except ValueError as e:
+            logger.warning(f"dropping frame {radio_buffer}: {e}")
+            rx_frames_dropped.inc()
+            self.channel_access.frame_failed()
+            if self.rate is not None:
+                self.rate.frame_failed()
+            return False
+        if header.dedup != (self.dedup_rx is not None):
+            logger.warning("dropping frame: dedup is on at one end only")
+            rx_frames_dropped.inc()
+            return False
+        rx_frames_ok.inc()
+        fec_repaired.inc(corrected)
+        self.channel_access.frame_received(header.flags)
+        if self.rate is not None:
+            await self.rate.frame_received(header)
+        fin = bool(header.flags & util.FLAG_FIN)
+        frame = (header.stream, segments, fin, header.stream_seq)
+        frames = [frame]
+        if self.arq is not None:
+            peer_restarts = self.arq.peer_restarts
+            frames = self.arq.frame_received(header, frame)
+            if self.arq.peer_restarts > peer_restarts and self.dedup_tx is not None:
+                # the peer's caches went with it
+                for entry in self.arq.unacked.values():
+                    stream_id, segments, fin, stream_seq = entry[0]
+                    segments = self.dedup_tx.literal(segments)
+                    entry[0] = (stream_id, segments, fin, stream_seq)
+                capacity = self.dedup_tx.capacity
+                self.dedup_tx = dedup_cache(capacity, side="send")
+                self.dedup_rx = dedup_cache(capacity, side="receive")
+        for stream_id, segments, fin, stream_seq in frames:
+            if self.dedup_rx is not None:
+                try:
+                    segments = self.dedup_rx.decode(segments)
+                except ValueError as e:
+                    logger.error(f"stream {stream_id} lost data: {e}")
+                    continue
+            # ack-only frames belong to no stream
+            if stream_id is not None:
+                await self.mux.deliver(stream_id, segments, fin, stream_seq)
+        return True
 
     def rig_info(self):
         logger.info(
-            f"bandwidth: {self.fl_client.rig.bandwidth}\n"
-            f"frequency: {self.fl_client.rig.frequency}\n"
-            f"mode: {self.fl_client.rig.mode}\n"
-            f"name: {self.fl_client.rig.name}\n"
+            f"bandwidth: {self.settings.get('rig.bandwidth')}\n"
+            f"frequency: {self.settings.get('rig.frequency')}\n"
+            f"mode: {self.settings.get('rig.mode')}\n"
+            f"name: {self.settings.get('rig.name')}\n"
         )
 
     def rig_modify(self, bw="", freq=0.0, mode="", name=""):
+        writes = []
         if bw is not None and bw != "":
-            self.fl_client.rig.bandwidth = bw
+            writes.append(("rig.bandwidth", bw))
         if freq is not None and freq != 0.0:
-            self.fl_client.rig.frequency = freq
+            writes.append(("rig.frequency", float(freq)))
         if mode is not None and mode != "":
-            self.fl_client.rig.mode = mode
+            writes.append(("rig.mode", str(mode)))
         if name is not None and name != "":
-            self.fl_client.rig.name = name
+            writes.append(("rig.name", str(name)))
+        self.apply(writes)
+
+    # Airtime figures for the named modem, or airtime.DEFAULT_MODEM's if we
+    # have none for it
+    def use_modem_rates(self, modem):
+        self.modem_timing = airtime.timing(modem)
+        # what we measured on the old modem no longer applies
+        self.measured_rate = None
+
+    # Switch modem from a trio task, keeping the airtime figures in step
+    async def set_modem(self, modem):
+        await self.xmlrpc(partial(self.modem_modify, modem=modem), name="modem_modify")
+        self.use_modem_rates(modem)
 
     def modem_info(self):
         logger.info(
-            f"bandwidth {self.fl_client.modem.bandwidth}\n"
-            f"carrier {self.fl_client.modem.carrier}\n"
-            f"modem {self.fl_client.modem.name}\n"
+            f"bandwidth {self.settings.get('modem.bandwidth')}\n"
+            f"carrier {self.settings.get('modem.carrier')}\n"
+            f"modem {self.settings.get('modem.name')}\n"
         )
 
     def modem_modify(self, bw=0, carrier=0, modem=""):
+        writes = []
         if bw is not None and bw != 0:
-            self.fl_client.modem.bandwidth = bw
+            writes.append(("modem.bandwidth", int(bw)))
         if carrier is not None and carrier != 0:
-            self.fl_client.modem.carrier = carrier
-            self.fl_client.main.afc = False
+            writes.append(("modem.carrier", int(carrier)))
+            writes.append(("main.afc", False))
         if (
                 modem is not None
                 and modem != ""
-                and self.fl_client.modem.names.count(modem) == 1
+                and self.settings.get("modem.names", []).count(modem) == 1
         ):
-            self.fl_client.modem.name = modem
+            writes.append(("modem.name", str(modem)))
+        self.apply(writes)
 
     def stop(self):
         self.fl_client.terminate(save_options=True)
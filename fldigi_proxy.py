@@ -6,15 +6,18 @@ basic settings in fldigi to better send packets vs. text
 """
 
 import logging
-from collections import deque
+import socket
+import struct
 from functools import partial
 
 import trio
 
 import util
+import metrics
+import qos
 from fldigi_client import fl_instance
-
-POLL_DELAY = 1.0
+from link_bond import bonded_link
+from stream_mux import MAX_STREAMS, radio_stream
 
 # Setup logging
 logging.basicConfig(
@@ -25,89 +28,171 @@ logger = logging.getLogger("proxy")
 urllib = logging.getLogger("urllib3.connectionpool")
 urllib.setLevel(logging.INFO)
 
+port_bytes_in = metrics.counter_metric(
+    "port_bytes_total", "Bytes of port data", direction="in"
+)
+port_bytes_out = metrics.counter_metric(
+    "port_bytes_total", "Bytes of port data", direction="out"
+)
+
 
-# use a timeout to detect the end of a message from a port
-# increment the timer proportional to data received
-# return data base64-encoded
-async def port_receive(recv_port: trio.SocketStream, packet_deque: deque):
+# read from the port until the peer closes it
+# when the stream's queue is full we stop reading, so TCP flow control pushes
+# back on the peer
+async def port_receive(recv_port: trio.SocketStream, send_stream: radio_stream):
     logger.info("calling port_receive")
-    while True:
-        data = await recv_port.receive_some(max_bytes=1024)
-        if not data:
-            await trio.sleep(POLL_DELAY)
-            continue
-        if data == b" " or b"":
-            await trio.sleep(POLL_DELAY)
-            continue
-        logger.info(f"port_received: {data}")
-        packet_deque.append(util.raw_to_base64(data))
-        logger.debug(f"packet queue: {packet_deque}")
-
-
-async def port_send(send_port: trio.SocketStream, packet_deque: deque):
+    async with send_stream:
+        while True:
+            data = await recv_port.receive_some(max_bytes=1024)
+            if not data:
+                logger.info("port closed by peer")
+                return
+            port_bytes_in.inc(len(data))
+            await send_stream.send(data)
+
+
+async def port_send(
+        send_port: trio.SocketStream, receive_channel: trio.MemoryReceiveChannel
+):
     logger.debug("calling port_send")
-    while True:
-        if len(packet_deque) > 0:
-            packet_buffer = util.base64_to_raw(packet_deque.popleft())
-            logger.info(f"port_sending {packet_buffer}")
+    async with receive_channel:
+        async for packet_buffer in receive_channel:
             await send_port.send_all(packet_buffer)
-        else:
-            await trio.sleep(POLL_DELAY)
-
-
-async def port_to_radio(fl_digi: fl_instance, proxy_port: trio.SocketStream):
-    logger.debug("Starting port_to_radio")
-    packet_deque = deque()
-    async with proxy_port:
+            port_bytes_out.inc(len(packet_buffer))
+
+
+# Proxy one connection over its radio stream, opening a new stream unless one
+# is given. When either end closes, the connection and the stream are closed.
+async def handle_conn(proxy_port, fl_main, stream=None):
+    if stream is None:
+        try:
+            stream = fl_main.mux.open_stream()
+        except RuntimeError as e:
+            logger.warning(f"refusing connection: {e}")
+            await proxy_port.aclose()
+            return
+    logger.info(f"Handling new connection on stream {stream.stream_id}")
+    async with proxy_port, stream:
         async with trio.open_nursery() as nursery:
-            nursery.start_soon(port_receive, proxy_port, packet_deque)
-            nursery.start_soon(fl_digi.radio_send_task, packet_deque)
 
-
-async def radio_to_port(fl_digi: fl_instance, proxy_port: trio.SocketStream):
-    logger.debug("Starting radio_to_port")
-    packet_deque = deque()
-    async with proxy_port:
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(fl_digi.radio_receive_task, packet_deque)
-            nursery.start_soon(port_send, proxy_port, packet_deque)
-
-
-async def handle_conn(stream, fl_main):
-    logger.info("Handling new connection")
+            async def radio_to_port():
+                await port_send(proxy_port, stream.rx_receive)
+                if stream.broken:
+                    # Some of the data is lost: abort the connection with a
+                    # RST, so the peer can't mistake it for a clean close
+                    proxy_port.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                    )
+                # The remote end closed the stream
+                nursery.cancel_scope.cancel()
+
+            nursery.start_soon(radio_to_port)
+            # Once the peer closes the port, stop receiving for this connection
+            await port_receive(proxy_port, stream)
+            nursery.cancel_scope.cancel()
+
+
+async def connect_stream(fl_main, port, stream):
+    try:
+        proxy_stream = await trio.open_tcp_stream("127.0.0.1", port)
+    except OSError as e:
+        logger.warning(f"could not connect stream {stream.stream_id}: {e}")
+        stream.close()
+        return
+    await handle_conn(proxy_stream, fl_main, stream)
+
+
+# Connect to the local port for stream 0 at startup, and again for every
+# stream the remote end opens
+async def serve_radio(fl_main, port):
+    fl_main.mux.accept_remote = True
     async with trio.open_nursery() as nursery:
-        nursery.start_soon(port_to_radio, fl_main, stream)
-        nursery.start_soon(radio_to_port, fl_main, stream)
+        nursery.start_soon(connect_stream, fl_main, port, fl_main.mux.open_stream(0))
+        async for stream in fl_main.mux.incoming:
+            nursery.start_soon(connect_stream, fl_main, port, stream)
 
 
 async def main():
     args = util.parse_args()
 
-    fl_main = fl_instance(
-        no_proxy=args.noproxy,
-        xml_port=args.xml,
-        proxy_in=args.proxy_in,
-        proxy_out=args.proxy_out,
-    )
-    util.fl_radio_settings(fl_main, args)
+    # One fl_instance per XML-RPC port; several are bonded into one link
+    xml_ports = args.xml or [None]
+    carriers = args.carrier or [None] * len(xml_ports)
+    links = []
+    for xml_port, carrier in zip(xml_ports, carriers):
+        # each bonded link keeps its own spool and trace
+        spool_path = args.spool
+        trace_path = args.record
+        if len(xml_ports) > 1:
+            if spool_path:
+                spool_path = f"{spool_path}.{xml_port}"
+            if trace_path:
+                trace_path = f"{trace_path}.{xml_port}"
+        fl_link = fl_instance(
+            no_proxy=args.noproxy,
+            xml_port=xml_port,
+            proxy_in=args.proxy_in,
+            proxy_out=args.proxy_out,
+            codec=args.codec,
+            use_compression=not args.nocompress,
+            batch_bytes=args.batch_bytes,
+            batch_airtime=args.batch_airtime,
+            access=args.access,
+            fec=args.fec,
+            arq_window=args.arq,
+            adapt_rate=args.adapt,
+            stream_tx=args.stream_tx,
+            dedup_bytes=args.dedup,
+            spool_path=spool_path,
+            trace_path=trace_path,
+        )
+        util.fl_radio_settings(fl_link, args, carrier)
+        links.append(fl_link)
+    if len(links) > 1:
+        bonded_link(links)
+    # Every link shares the stream multiplexer, so connections can use any one
+    fl_main = links[0]
+    fl_main.mux.qos = args.qos
+    fl_main.mux.classifier = qos.classifier(args.qos_rule)
+    # Frames resumed from a spool belong to streams that died with the old
+    # process; new connections mustn't reuse their IDs while the peer has them
+    resumed = [
+        frame[0]
+        for link in links
+        if link.arq is not None
+        for frame, _ in link.arq.unacked.values()
+    ]
+    if resumed:
+        fl_main.mux.next_id = (max(resumed) + 1) % MAX_STREAMS
 
     ####################################################################################
     # TCP proxy mode
     ####################################################################################
 
-    # C-Lightning is going to make a new _outbound_ connection to a remote node via the
-    # radio. We listen on args.proxy_in
-    if args.proxy_out:
-        # Use functools.partial to pass fl_main into the handler
-        _handle_func = partial(handle_conn, fl_main=fl_main)
-        await trio.serve_tcp(_handle_func, int(args.proxy_out), host="127.0.0.1")
-
-    # We are receiving a connection from a remote node, so we make an inbound connection
-    # to lnproxy
-    if args.proxy_in:
-        proxy_stream = await trio.open_tcp_stream("127.0.0.1", args.proxy_in)
-        async with proxy_stream:
-            await handle_conn(proxy_stream, fl_main)
+    if not (args.proxy_out or args.proxy_in):
+        return
+
+    # One radio TX scheduler and RX demultiplexer per link serve every connection
+    async with trio.open_nursery() as nursery:
+        if args.metrics_port:
+            nursery.start_soon(metrics.serve_http, args.metrics_port)
+        if args.metrics_file:
+            nursery.start_soon(metrics.write_jsonl, args.metrics_file, args.metrics_interval)
+        for fl_link in links:
+            nursery.start_soon(fl_link.radio_send_task)
+            nursery.start_soon(fl_link.radio_receive_task)
+
+        # C-Lightning is going to make new _outbound_ connections to remote nodes
+        # via the radio. We listen on args.proxy_out, one stream per connection
+        if args.proxy_out:
+            # Use functools.partial to pass fl_main into the handler
+            _handle_func = partial(handle_conn, fl_main=fl_main)
+            await trio.serve_tcp(_handle_func, int(args.proxy_out), host="127.0.0.1")
+
+        # We are receiving connections from remote nodes, so we make an inbound
+        # connection to lnproxy for each stream
+        if args.proxy_in:
+            await serve_radio(fl_main, args.proxy_in)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3.8
+
+"""
+Stand-in for fldigi: serves the XML-RPC methods pyfldigi uses on one port per
+simulated instance, and connects the instances through a virtual channel with
+per-modem bitrates, propagation delay, character errors and half-duplex
+collisions, so proxies can be run against each other without fldigi or audio
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import socketserver
+import threading
+import time
+from xmlrpc.server import SimpleXMLRPCServer
+
+import airtime
+
+logger = logging.getLogger("sim")
+
+# Occupied bandwidth in Hz of each modem we simulate; bitrates and preambles
+# come from airtime.MODEMS
+MODEMS = {
+    "BPSK31": 31,
+    "BPSK63": 63,
+    "BPSK125": 125,
+    "BPSK250": 250,
+    "PSK125R": 125,
+    "PSK250R": 250,
+    "PSK500R": 500,
+}
+MODEM_NAMES = list(MODEMS)
+# Characters a garbled character can turn into
+NOISE_CHARS = bytes(range(0x20, 0x7F))
+
+
+# fldigi sends a newline as CR LF
+def on_air(char):
+    if char == ord("\n"):
+        return b"\r\n"
+    return bytes([char & 0x7F])
+
+
+class sim_station:
+    def __init__(self, channel, port):
+        self.channel = channel
+        self.port = port
+        self.state = "RX"
+        self.modem = "BPSK31"
+        self.carrier = 1500
+        self.modem_bandwidth = MODEMS[self.modem]
+        self.afc = True
+        self.afc_search_range = 100
+        self.squelch = True
+        self.squelch_level = 50.0
+        self.reverse = False
+        self.locked = False
+        self.rsid = False
+        self.rig_name = "simulated"
+        self.rig_frequency = 14070000.0
+        self.rig_mode = "USB"
+        self.rig_bandwidth = "3000"
+        # text in the TX widget not yet sent, sent since the last tx.get_data,
+        # and received since the last rx.get_data
+        self.tx_text = bytearray()
+        self.tx_sent = bytearray()
+        self.rx_text = bytearray()
+        # bits of airtime the transmitter may still spend this tick
+        self.tx_credit = 0.0
+        # when a signal we can decode was last on the channel
+        self.signal_at = 0.0
+        # totals for benchmarks, served as sim.get_stats
+        self.tx_seconds = 0.0
+        self.chars_sent = 0
+        self.bits_sent = 0
+        self.server = None
+        self.terminated = False
+
+    # Frequency of the signal on air, for deciding who hears whom
+    def frequency(self):
+        return self.rig_frequency + self.carrier
+
+    def bandwidth(self):
+        return MODEMS[self.modem]
+
+    def timing(self):
+        return airtime.MODEMS[self.modem]
+
+    def transmitting(self):
+        return self.state in ("TX", "TUNE")
+
+    def key_up(self, state):
+        if not self.transmitting():
+            # no text goes out during the preamble
+            timing = self.timing()
+            self.tx_credit = -timing.preamble * timing.bitrate
+        self.state = state
+
+    # Send what the airtime since the last tick allows
+    # returns the characters put on air
+    def transmit(self, elapsed):
+        if self.state != "TX":
+            return b""
+        timing = self.timing()
+        self.tx_credit += elapsed * timing.bitrate * self.channel.speedup
+        sent = bytearray()
+        while self.tx_text:
+            bits = timing.char_bits[self.tx_text[0]]
+            if bits > self.tx_credit:
+                break
+            self.tx_credit -= bits
+            self.bits_sent += bits
+            char = self.tx_text.pop(0)
+            self.tx_sent.append(char)
+            sent += on_air(char)
+        if not self.tx_text:
+            # idle phase reversals fill the gap; airtime is not saved up
+            self.tx_credit = min(self.tx_credit, 0.0)
+        self.chars_sent += len(sent)
+        return bytes(sent)
+
+    # XML-RPC methods, by the name fldigi serves them under
+    def methods(self):
+        return {
+            "fldigi.name": lambda: "fldigi",
+            "fldigi.version": lambda: "4.1.00",
+            "fldigi.version_struct": lambda: {"major": 4, "minor": 1, "patch": ".00"},
+            "fldigi.config_dir": lambda: f"/tmp/fldigi_sim/{self.port}/",
+            "fldigi.list": self.list_methods,
+            "fldigi.terminate": self.terminate,
+            "main.get_trx_status": self.get_trx_status,
+            "main.get_trx_state": self.get_trx_status,
+            "main.tx": self.tx,
+            "main.tune": self.tune,
+            "main.rx": self.rx,
+            "main.abort": self.abort,
+            "main.get_squelch": lambda: self.squelch,
+            "main.set_squelch": self.setter("squelch"),
+            "main.get_squelch_level": lambda: self.squelch_level,
+            "main.set_squelch_level": self.setter("squelch_level"),
+            "main.get_afc": lambda: self.afc,
+            "main.set_afc": self.setter("afc"),
+            "main.get_reverse": lambda: self.reverse,
+            "main.set_reverse": self.setter("reverse"),
+            "main.get_lock": lambda: self.locked,
+            "main.set_lock": self.setter("locked"),
+            "main.get_rsid": lambda: self.rsid,
+            "main.set_rsid": self.setter("rsid"),
+            "modem.get_name": lambda: self.modem,
+            "modem.set_by_name": self.set_modem_by_name,
+            "modem.get_names": lambda: MODEM_NAMES,
+            "modem.get_id": lambda: MODEM_NAMES.index(self.modem),
+            "modem.set_by_id": self.set_modem_by_id,
+            "modem.get_max_id": lambda: len(MODEM_NAMES) - 1,
+            "modem.get_carrier": lambda: self.carrier,
+            "modem.set_carrier": self.setter("carrier"),
+            "modem.get_bandwidth": lambda: self.modem_bandwidth,
+            "modem.set_bandwidth": self.setter("modem_bandwidth"),
+            "modem.get_afc_search_range": lambda: self.afc_search_range,
+            "modem.set_afc_search_range": self.setter("afc_search_range"),
+            "modem.get_quality": self.get_quality,
+            "rig.get_name": lambda: self.rig_name,
+            "rig.set_name": self.setter("rig_name"),
+            "rig.get_frequency": lambda: self.rig_frequency,
+            "rig.set_frequency": self.setter("rig_frequency"),
+            "rig.get_mode": lambda: self.rig_mode,
+            "rig.set_mode": self.setter("rig_mode"),
+            "rig.get_modes": lambda: ["USB", "LSB", "CW", "FM", "AM"],
+            "rig.get_bandwidth": lambda: self.rig_bandwidth,
+            "rig.set_bandwidth": self.setter("rig_bandwidth"),
+            "rig.get_bandwidths": lambda: ["2400", "3000"],
+            "rig.take_control": lambda: None,
+            "rig.release_control": lambda: None,
+            "text.add_tx": self.add_tx,
+            "text.add_tx_bytes": self.add_tx,
+            "text.clear_tx": self.clear_tx,
+            "text.clear_rx": self.clear_rx,
+            "text.get_rx_length": lambda: len(self.rx_text),
+            "tx.get_data": self.get_tx_data,
+            "rx.get_data": self.get_rx_data,
+            "sim.get_stats": self.get_stats,
+        }
+
+    def list_methods(self):
+        return [{"name": name, "signature": "", "help": ""} for name in self.methods()]
+
+    # fldigi's setters hand back the old value
+    def setter(self, attribute):
+        def set_value(value):
+            with self.channel.lock:
+                old = getattr(self, attribute)
+                setattr(self, attribute, value)
+                return old
+
+        return set_value
+
+    def get_trx_status(self):
+        return self.state.lower()
+
+    def tx(self):
+        with self.channel.lock:
+            self.key_up("TX")
+
+    def tune(self):
+        with self.channel.lock:
+            self.key_up("TUNE")
+
+    def rx(self):
+        with self.channel.lock:
+            self.state = "RX"
+
+    # Stop transmitting at once, dropping any text not yet sent
+    def abort(self):
+        with self.channel.lock:
+            self.state = "RX"
+            self.tx_text.clear()
+
+    def set_modem_by_name(self, name):
+        with self.channel.lock:
+            old = self.modem
+            if name in MODEMS:
+                self.modem = name
+                self.modem_bandwidth = MODEMS[name]
+            return old
+
+    def set_modem_by_id(self, modem_id):
+        return self.set_modem_by_name(MODEM_NAMES[modem_id])
+
+    # Signal quality as fldigi's PSK decoders report it, 0 to 100; it holds
+    # for a moment after the signal goes, and is 0 on an empty channel
+    def get_quality(self):
+        with self.channel.lock:
+            if time.monotonic() - self.signal_at > self.channel.signal_hold:
+                return 0
+            return round(100 * (1 - self.channel.error_rate(self.modem)) ** 8)
+
+    def add_tx(self, text):
+        if isinstance(text, str):
+            text = text.encode()
+        with self.channel.lock:
+            self.tx_text += text
+
+    def clear_tx(self):
+        with self.channel.lock:
+            self.tx_text.clear()
+
+    def clear_rx(self):
+        with self.channel.lock:
+            self.rx_text.clear()
+
+    def get_tx_data(self):
+        with self.channel.lock:
+            data = bytes(self.tx_sent)
+            self.tx_sent.clear()
+            return data
+
+    def get_rx_data(self):
+        with self.channel.lock:
+            data = bytes(self.rx_text)
+            self.rx_text.clear()
+            return data
+
+    # Airtime and characters sent so far; not part of fldigi's interface
+    def get_stats(self):
+        with self.channel.lock:
+            return {
+                "tx_seconds": self.tx_seconds,
+                "chars_sent": self.chars_sent,
+                "bits_sent": self.bits_sent,
+            }
+
+    # The reply has to go out before the server stops
+    def terminate(self, bitmask=0):
+        logger.info(f"instance on port {self.port} terminated")
+        self.terminated = True
+        threading.Thread(target=self.stop, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class sim_server(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Every station hears every other one on the same modem within its bandwidth;
+# characters arrive delay seconds after they are sent
+class sim_channel:
+    tick = 0.01
+    signal_hold = 0.5
+
+    def __init__(self, delay=0.0, error_rate=0.0, modem_error_rates=None, speedup=1.0, seed=None):
+        self.delay = delay
+        self.default_error_rate = error_rate
+        self.modem_error_rates = modem_error_rates or {}
+        self.speedup = speedup
+        self.random = random.Random(seed)
+        self.stations = []
+        self.lock = threading.Lock()
+        # (arrival time, order, receiving station, character, collided)
+        self.in_flight = []
+        self.order = itertools.count()
+        self.running = False
+
+    def error_rate(self, modem):
+        return self.modem_error_rates.get(modem, self.default_error_rate)
+
+    def add_station(self, port, host="127.0.0.1"):
+        station = sim_station(self, port)
+        station.server = sim_server(
+            (host, port), logRequests=False, allow_none=True, use_builtin_types=True
+        )
+        for name, method in station.methods().items():
+            station.server.register_function(method, name)
+        station.server.register_multicall_functions()
+        self.stations.append(station)
+        return station
+
+    # Whether rx can decode tx: same modem, and tx inside rx's passband
+    def hears(self, rx, tx):
+        if rx is tx or rx.modem != tx.modem:
+            return False
+        return abs(rx.frequency() - tx.frequency()) < tx.bandwidth() / 2
+
+    # Whether two signals share any spectrum, whatever their modems
+    def overlaps(self, a, b):
+        return abs(a.frequency() - b.frequency()) < (a.bandwidth() + b.bandwidth()) / 2
+
+    def step(self, now, elapsed):
+        for station in self.stations:
+            if station.transmitting():
+                station.tx_seconds += elapsed
+        for rx in self.stations:
+            if any(tx.transmitting() and self.hears(rx, tx) for tx in self.stations):
+                rx.signal_at = now + self.delay
+        for station in self.stations:
+            sent = station.transmit(elapsed)
+            if not sent:
+                continue
+            collided = any(
+                other is not station and other.transmitting() and self.overlaps(other, station)
+                for other in self.stations
+            )
+            for rx in self.stations:
+                if self.hears(rx, station):
+                    for char in sent:
+                        heapq.heappush(
+                            self.in_flight,
+                            (now + self.delay, next(self.order), rx, char, collided),
+                        )
+        while self.in_flight and self.in_flight[0][0] <= now:
+            _, _, rx, char, collided = heapq.heappop(self.in_flight)
+            # half duplex: nothing is heard while transmitting
+            if rx.transmitting():
+                continue
+            if collided or self.random.random() < self.error_rate(rx.modem):
+                # a garbled character is as often lost as decoded wrong
+                if self.random.random() < 0.5:
+                    continue
+                char = self.random.choice(NOISE_CHARS)
+            rx.rx_text.append(char)
+
+    def run(self):
+        self.running = True
+        last = time.monotonic()
+        while self.running:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            with self.lock:
+                self.step(now, now - last)
+            last = now
+
+    def start(self):
+        for station in self.stations:
+            threading.Thread(target=station.server.serve_forever, daemon=True).start()
+            logger.info(f"simulated fldigi listening on XML-RPC port {station.port}")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for station in self.stations:
+            if not station.terminated:
+                station.stop()
+
+
+def parse_error_rate(text):
+    modem, _, rate = text.partition("=")
+    if modem not in MODEMS:
+        raise argparse.ArgumentTypeError(f"unknown modem {modem}")
+    try:
+        return modem, float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad error rate {rate}") from None
+
+
+def main():
+    # fmt: off
+    parser = argparse.ArgumentParser(description="simulate fldigi instances sharing one radio channel")
+    parser.add_argument("--xml", type=int, nargs="+", default=[7362, 7363], help="XML-RPC port for each simulated fldigi")
+    parser.add_argument("--delay", type=float, default=0.0, help="propagation delay in seconds")
+    parser.add_argument("--errors", type=float, default=0.0, help="chance that a received character is lost or garbled")
+    parser.add_argument("--modem_errors", type=parse_error_rate, nargs="+", default=[], help="error chance for a given modem, as MODEM=RATE")
+    parser.add_argument("--speedup", type=float, default=1.0, help="multiply every modem's bitrate")
+    parser.add_argument("--seed", type=int, help="seed the error and collision randomness")
+    parser.add_argument("--debug", default=False, help="Add debug output", action="store_true")
+    # fmt: on
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    channel = sim_channel(
+        delay=args.delay,
+        error_rate=args.errors,
+        modem_error_rates=dict(args.modem_errors),
+        speedup=args.speedup,
+        seed=args.seed,
+    )
+    for port in args.xml:
+        channel.add_station(port)
+    channel.start()
+    try:
+        while not all(station.terminated for station in channel.stations):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    channel.stop()
+
+
+if __name__ == "__main__":
+    main()
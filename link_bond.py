@@ -0,0 +1,36 @@
+"""
+Bond several fldigi instances on separate carriers into one link: the
+instances share one stream_multiplexer, each takes a share of the waiting
+port data in proportion to its measured rate, and the receiver puts each
+stream's frames back in order
+"""
+
+import logging
+
+from stream_mux import stream_multiplexer
+
+logger = logging.getLogger("fldigi")
+
+
+class bonded_link:
+    def __init__(self, links):
+        self.links = links
+        self.mux = stream_multiplexer()
+        # Frames of one stream go out on different carriers, so they may
+        # arrive out of order
+        self.mux.sequenced = True
+        # ARQ resends lost frames, so a gap is only waited out
+        self.mux.reliable = all(link.arq is not None for link in links)
+        for link in links:
+            link.mux = self.mux
+            link.bond = self
+        logger.info(f"bonding {len(links)} fldigi instances")
+
+    # Bytes of the waiting port data that link should take now: its rate's
+    # share of the rate of every link free to transmit. Links that are busy
+    # sending will take what is left when they come back.
+    def share(self, link):
+        free = [other for other in self.links if other is link or not other.sending]
+        total_rate = sum(other.expected_rate() for other in free)
+        queued = self.mux.queued_bytes()
+        return int(queued * link.expected_rate() / total_rate)
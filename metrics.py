@@ -0,0 +1,191 @@
+"""
+Counters, gauges and histograms for each stage of the proxy, served as
+Prometheus text over HTTP or written out periodically as JSON lines
+"""
+
+import bisect
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+import trio
+
+logger = logging.getLogger("metrics")
+
+NAMESPACE = "fldigi_proxy"
+# upper bounds in seconds, from an XML-RPC call to a long transmission
+# fmt: off
+TIME_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0,
+)
+# fmt: on
+BYTE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+HTTP_MAX_REQUEST = 8192
+
+
+class counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Observe how long the block takes
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {format_bound(bound): n for bound, n in self.cumulative()},
+        }
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(bound)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+# Metrics by name and labels. Each name is one family of one kind; asking
+# for the same name and labels again returns the same metric.
+class metric_registry:
+    def __init__(self):
+        # name -> (kind, help, {labels: metric})
+        self.families = {}
+
+    def get(self, kind, name, help_text, labels, make):
+        family = self.families.setdefault(name, (kind, help_text, {}))
+        if family[0] != kind:
+            raise ValueError(f"{name} is already a {family[0]}")
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = make()
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self.get("counter", name, help_text, labels, counter)
+
+    def gauge(self, name, help_text, **labels):
+        return self.get("gauge", name, help_text, labels, gauge)
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, **labels):
+        return self.get("histogram", name, help_text, labels, lambda: histogram(buckets))
+
+    def prometheus_text(self):
+        lines = []
+        for name, (kind, help_text, metrics) in sorted(self.families.items()):
+            full_name = f"{NAMESPACE}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, metric in metrics.items():
+                if kind != "histogram":
+                    lines.append(f"{full_name}{format_labels(labels)} {metric.value}")
+                    continue
+                for bound, total in metric.cumulative():
+                    bucket_labels = labels + (("le", format_bound(bound)),)
+                    lines.append(f"{full_name}_bucket{format_labels(bucket_labels)} {total}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {metric.sum}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    # Every metric's current value, keyed by name and labels as Prometheus
+    # writes them
+    def snapshot(self):
+        values = {}
+        for name, (_, _, metrics) in sorted(self.families.items()):
+            for labels, metric in metrics.items():
+                values[name + format_labels(labels)] = metric.snapshot()
+        return values
+
+
+registry = metric_registry()
+counter_metric = registry.counter
+gauge_metric = registry.gauge
+histogram_metric = registry.histogram
+
+
+# A bare-bones HTTP/1.0 server answering every GET with the Prometheus text
+async def handle_http(stream):
+    request = b""
+    async with stream:
+        while b"\r\n\r\n" not in request and len(request) < HTTP_MAX_REQUEST:
+            data = await stream.receive_some(HTTP_MAX_REQUEST)
+            if not data:
+                return
+            request += data
+        body = registry.prometheus_text().encode()
+        header = (
+            "HTTP/1.0 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        )
+        try:
+            await stream.send_all(header.encode() + body)
+        except trio.BrokenResourceError:
+            pass
+
+
+async def serve_http(port):
+    logger.info(f"serving metrics on http://127.0.0.1:{port}/metrics")
+    await trio.serve_tcp(handle_http, port, host="127.0.0.1")
+
+
+# Append a snapshot of every metric to path every interval seconds
+async def write_jsonl(path, interval):
+    logger.info(f"writing metrics to {path} every {interval}s")
+    while True:
+        await trio.sleep(interval)
+        line = json.dumps({"time": time.time(), "metrics": registry.snapshot()})
+        with open(path, "a") as output:
+            output.write(line + "\n")
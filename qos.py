@@ -0,0 +1,79 @@
+"""
+Priority classes for port data: classify each segment by the Lightning
+message it starts with, and pick which class the TX scheduler serves next
+"""
+
+import logging
+
+logger = logging.getLogger("fldigi")
+
+# Classes from most to least urgent: connection setup and liveness, channel
+# and payment updates, anything unrecognised, then gossip
+CLASSES = ("control", "payment", "default", "gossip")
+RANK = {name: rank for rank, name in enumerate(CLASSES)}
+# Share of the segments each class gets under weighted scheduling, while
+# every class has data waiting
+WEIGHTS = {"control": 8, "payment": 4, "default": 2, "gossip": 1}
+SCHEDULERS = ("strict", "weighted")
+
+# BOLT 1 setup and control, BOLT 2 channel establishment, close and HTLC
+# updates, and BOLT 7 gossip
+# fmt: off
+TYPE_CLASSES = {
+    1: "control", 16: "control", 17: "control", 18: "control", 19: "control",
+    32: "payment", 33: "payment", 34: "payment", 35: "payment", 36: "payment",
+    38: "payment", 39: "payment",
+    128: "payment", 130: "payment", 131: "payment", 132: "payment",
+    133: "payment", 134: "payment", 135: "payment", 136: "payment",
+    256: "gossip", 257: "gossip", 258: "gossip", 259: "gossip", 261: "gossip",
+    263: "gossip", 264: "gossip", 265: "gossip",
+}
+# fmt: on
+# Noise handshake acts one and two, and act three
+HANDSHAKE_SIZES = (50, 66)
+
+
+# The Lightning message type a segment starts with, or None. lnproxy passes
+# messages with a 2-byte length before the type; when that length doesn't
+# fit the segment, the segment is taken to start with a bare message.
+def message_type(segment):
+    if len(segment) >= 4 and int.from_bytes(segment[:2], "big") + 2 <= len(segment):
+        return int.from_bytes(segment[2:4], "big")
+    if len(segment) >= 2:
+        return int.from_bytes(segment[:2], "big")
+    return None
+
+
+# Classifies segments by message type, with rules overriding TYPE_CLASSES
+class classifier:
+    # rules are "TYPE=CLASS" strings
+    # raises ValueError for a malformed rule or unknown class
+    def __init__(self, rules=()):
+        self.type_classes = dict(TYPE_CLASSES)
+        for rule in rules:
+            msg_type, _, name = rule.partition("=")
+            if name not in RANK:
+                raise ValueError(f"bad QoS rule {rule}: class must be one of {CLASSES}")
+            self.type_classes[int(msg_type)] = name
+
+    def classify(self, segment):
+        if len(segment) in HANDSHAKE_SIZES and segment[0] == 0:
+            return "control"
+        return self.type_classes.get(message_type(segment), "default")
+
+
+# Smooth weighted round robin over the classes with data waiting: each turn
+# every waiting class gains its weight, and the class with the most credit
+# is served and pays back the total
+class weighted_picker:
+    def __init__(self):
+        self.credit = dict.fromkeys(CLASSES, 0)
+
+    def pick(self, waiting):
+        total = 0
+        for name in waiting:
+            self.credit[name] += WEIGHTS[name]
+            total += WEIGHTS[name]
+        chosen = max(waiting, key=lambda name: (self.credit[name], -RANK[name]))
+        self.credit[chosen] -= total
+        return chosen
@@ -0,0 +1,57 @@
+"""
+Binary traces of what one fl_instance read from and handed to fldigi: every
+raw RX fragment and every TX buffer, timestamped, for replay.py to feed back
+through the receive pipeline offline
+"""
+
+import logging
+import struct
+import time
+
+logger = logging.getLogger("fldigi")
+
+MAGIC = b"FPT1"
+# Each record is a kind byte, seconds since the trace started as a double,
+# the data length, then the data
+RECORD = struct.Struct(">cdI")
+# A fragment from text.get_rx_data, before any processing
+KIND_RX = b"R"
+# A buffer of frames handed to fldigi to transmit
+KIND_TX = b"T"
+
+
+class trace_writer:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        logger.info(f"recording RX and TX to {path}")
+
+    def write(self, kind, data):
+        self.file.write(RECORD.pack(kind, time.monotonic() - self.start, len(data)))
+        self.file.write(data)
+        # a crash should lose at most the record being written
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Every record of a trace as (kind, seconds, data), stopping quietly at a
+# record cut short by a crash
+# raises ValueError for a file that isn't a trace
+def read_trace(path):
+    with open(path, "rb") as trace_file:
+        if trace_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a trace")
+        while True:
+            header = trace_file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, seconds, size = RECORD.unpack(header)
+            data = trace_file.read(size)
+            if len(data) < size:
+                logger.warning(f"trace {path} ends mid-record")
+                return
+            yield kind, seconds, data
@@ -0,0 +1,216 @@
+"""
+Modem rate adaptation: track how well frames decode, and negotiate with the
+peer in-band to step the modem up or down so both ends switch together
+"""
+
+import collections
+import logging
+
+import trio
+
+logger = logging.getLogger("fldigi")
+
+# Modems to step between, slowest first; the rate byte in a frame header
+# carries an index into this list
+MODEM_LADDER = ["BPSK63", "PSK125R", "PSK250R", "PSK500R"]
+# Set in the rate byte when it accepts a proposal rather than making one
+RATE_ACCEPT = 0x80
+
+
+# One end proposes a modem in the rate byte of its next transmission. The peer
+# answers with RATE_ACCEPT and the modem it agrees to, which is its current
+# modem if it refuses, and switches once that transmission is sent. The
+# proposer switches as soon as it hears the accept, since it transmits next.
+# Either end that hears nothing for link_timeout falls back to the modem it
+# started on. If a lost accept leaves the ends on different modems, neither
+# hears the other, so both fall back and meet there.
+class rate_controller:
+    # frame results and decoder quality samples kept for the decision
+    window = 20
+    min_frames = 8
+    step_down_success = 0.8
+    step_down_quality = 40.0
+    step_up_success = 0.98
+    step_up_quality = 75.0
+    # seconds on a modem before trying the next one up, doubled up to
+    # max_holdoff every time a modem turns out not to work
+    holdoff = 60.0
+    max_holdoff = 960.0
+    proposal_timeout = 30.0
+    link_timeout = 60.0
+
+    def __init__(self, fl_digi):
+        self.fl_digi = fl_digi
+        # index into MODEM_LADDER, None until start() finds a modem we adapt
+        self.index = None
+        self.results = collections.deque(maxlen=self.window)
+        self.qualities = collections.deque(maxlen=self.window)
+        self.proposed = None
+        self.proposed_at = 0.0
+        self.proposal_sent = False
+        # modem index to accept in our next transmission, and to switch to
+        # once it is sent
+        self.accept = None
+        self.accept_sent = None
+        self.fallback = None
+        self.changed_at = 0.0
+        self.last_heard = 0.0
+        self.up_holdoff = self.holdoff
+        self.work_event = trio.Event()
+
+    def start(self, modem):
+        if modem not in MODEM_LADDER:
+            logger.warning(f"not adapting rate: {modem} is not one of {MODEM_LADDER}")
+            return
+        self.index = MODEM_LADDER.index(modem)
+        self.fallback = self.index
+        self.changed_at = trio.current_time()
+        self.last_heard = self.changed_at
+
+    async def switch(self, index):
+        old_modem = MODEM_LADDER[self.index]
+        await self.fl_digi.set_modem(MODEM_LADDER[index])
+        logger.info(f"modem {old_modem} -> {MODEM_LADDER[index]}")
+        if index < self.index:
+            self.up_holdoff = min(self.up_holdoff * 2, self.max_holdoff)
+        self.index = index
+        self.changed_at = trio.current_time()
+        self.results.clear()
+        self.qualities.clear()
+
+    def link_stats(self):
+        if len(self.results) < self.min_frames:
+            return None
+        success = sum(self.results) / len(self.results)
+        quality = sum(self.qualities) / max(len(self.qualities), 1)
+        return success, quality
+
+    # Whether our side of the link would cope with the modem at index
+    def acceptable(self, index):
+        if index <= self.index:
+            return True
+        stats = self.link_stats()
+        if stats is None:
+            return False
+        success, quality = stats
+        return success >= self.step_up_success and quality >= self.step_up_quality
+
+    # Propose a step down when frames fail or the signal is poor, and a step
+    # up when the link has been clean for holdoff
+    def evaluate(self):
+        now = trio.current_time()
+        if self.proposed is not None and now - self.proposed_at > self.proposal_timeout:
+            logger.info(f"no answer to proposing {MODEM_LADDER[self.proposed]}")
+            self.proposed = None
+        if self.proposed is not None or self.accept is not None:
+            return
+        stats = self.link_stats()
+        if stats is None:
+            return
+        success, quality = stats
+        target = None
+        if success < self.step_down_success or quality < self.step_down_quality:
+            if self.index > 0:
+                target = self.index - 1
+        elif self.acceptable(self.index + 1) and now - self.changed_at > self.up_holdoff:
+            if self.index < len(MODEM_LADDER) - 1:
+                target = self.index + 1
+        if target is not None:
+            logger.info(
+                f"proposing {MODEM_LADDER[target]}: "
+                f"{success:.0%} frames decoded, quality {quality:.0f}"
+            )
+            self.propose(target)
+
+    def propose(self, index):
+        self.proposed = index
+        self.proposed_at = trio.current_time()
+        self.proposal_sent = False
+        self.work_event.set()
+
+    def frame_failed(self):
+        if self.index is None:
+            return
+        self.results.append(False)
+        self.evaluate()
+
+    async def frame_received(self, header):
+        if self.index is None:
+            return
+        fl_client = self.fl_digi.fl_client
+        quality = await self.fl_digi.xmlrpc(
+            lambda: fl_client.modem.quality, name="get_quality"
+        )
+        self.results.append(True)
+        self.qualities.append(quality)
+        self.last_heard = trio.current_time()
+        if header.rate is not None:
+            await self.rate_received(header.rate)
+        self.evaluate()
+
+    async def rate_received(self, rate):
+        index = rate & ~RATE_ACCEPT
+        if index >= len(MODEM_LADDER):
+            logger.warning(f"ignoring unknown modem index {index}")
+            return
+        if rate & RATE_ACCEPT:
+            if self.proposed is None:
+                return
+            self.proposed = None
+            if index != self.index:
+                await self.switch(index)
+            else:
+                logger.info("peer kept the current modem")
+                self.changed_at = trio.current_time()
+            return
+        # Both ends proposing: the slower modem wins
+        if self.proposed is not None and self.proposed < index:
+            return
+        self.proposed = None
+        self.accept = index if self.acceptable(index) else self.index
+        self.work_event.set()
+
+    # The rate byte for our next transmission, if we have something to say
+    def control(self):
+        self.accept_sent = self.accept
+        if self.accept is not None:
+            return self.accept | RATE_ACCEPT
+        if self.proposed is not None:
+            self.proposal_sent = True
+        return self.proposed
+
+    def has_work(self):
+        return self.accept is not None or (
+            self.proposed is not None and not self.proposal_sent
+        )
+
+    # Wait until we owe the peer an answer or have a new proposal to make
+    async def wait_for_work(self):
+        while not self.has_work():
+            await self.work_event.wait()
+            self.work_event = trio.Event()
+
+    async def transmission_sent(self):
+        if self.accept_sent is None:
+            return
+        index = self.accept_sent
+        if self.accept == index:
+            self.accept = None
+        self.accept_sent = None
+        if index != self.index:
+            await self.switch(index)
+
+    # Called every poll: fall back to the starting modem when nothing has been
+    # heard for link_timeout on this one
+    async def check_link(self):
+        if self.index is None or self.index == self.fallback:
+            return
+        now = trio.current_time()
+        if now - max(self.last_heard, self.changed_at) > self.link_timeout:
+            logger.warning(
+                f"nothing heard on {MODEM_LADDER[self.index]}, "
+                f"falling back to {MODEM_LADDER[self.fallback]}"
+            )
+            self.proposed = None
+            self.accept = None
+            await self.switch(self.fallback)
@@ -0,0 +1,185 @@
+"""
+Reed-Solomon error correction over GF(2^8), for repairing radio frames
+https://en.wikiversity.org/wiki/Reed%E2%80%93Solomon_codes_for_coders
+"""
+
+# Field generator polynomial x^8 + x^4 + x^3 + x^2 + 1, and the largest codeword
+PRIM = 0x11D
+BLOCK_SIZE = 255
+
+
+def _gf_tables():
+    gf_exp = [0] * (BLOCK_SIZE * 2)
+    gf_log = [0] * (BLOCK_SIZE + 1)
+    x = 1
+    for i in range(BLOCK_SIZE):
+        gf_exp[i] = x
+        gf_log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= PRIM
+    # doubled so products of logs never need reducing mod 255
+    for i in range(BLOCK_SIZE, BLOCK_SIZE * 2):
+        gf_exp[i] = gf_exp[i - BLOCK_SIZE]
+    return gf_exp, gf_log
+
+
+GF_EXP, GF_LOG = _gf_tables()
+
+
+def gf_mul(x, y):
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+
+def gf_div(x, y):
+    if y == 0:
+        raise ZeroDivisionError()
+    if x == 0:
+        return 0
+    return GF_EXP[(GF_LOG[x] + BLOCK_SIZE - GF_LOG[y]) % BLOCK_SIZE]
+
+
+def gf_pow(x, power):
+    return GF_EXP[(GF_LOG[x] * power) % BLOCK_SIZE]
+
+
+def gf_inverse(x):
+    return GF_EXP[BLOCK_SIZE - GF_LOG[x]]
+
+
+# Polynomials are lists of coefficients, highest degree first
+def gf_poly_scale(p, x):
+    return [gf_mul(coef, x) for coef in p]
+
+
+def gf_poly_add(p, q):
+    r = [0] * max(len(p), len(q))
+    r[len(r) - len(p) :] = p
+    for i, coef in enumerate(q):
+        r[i + len(r) - len(q)] ^= coef
+    return r
+
+
+def gf_poly_mul(p, q):
+    r = [0] * (len(p) + len(q) - 1)
+    for j, q_coef in enumerate(q):
+        for i, p_coef in enumerate(p):
+            r[i + j] ^= gf_mul(p_coef, q_coef)
+    return r
+
+
+def gf_poly_eval(poly, x):
+    y = poly[0]
+    for coef in poly[1:]:
+        y = gf_mul(y, x) ^ coef
+    return y
+
+
+_generators = {}
+
+
+def rs_generator_poly(nsym):
+    if nsym not in _generators:
+        g = [1]
+        for i in range(nsym):
+            g = gf_poly_mul(g, [1, gf_pow(2, i)])
+        _generators[nsym] = g
+    return _generators[nsym]
+
+
+# Systematic encoding: returns the nsym parity bytes for msg
+def rs_parity(msg, nsym):
+    if len(msg) + nsym > BLOCK_SIZE:
+        raise ValueError(f"message too long for one block: {len(msg)}")
+    gen = rs_generator_poly(nsym)
+    remainder = list(msg) + [0] * nsym
+    for i in range(len(msg)):
+        coef = remainder[i]
+        if coef != 0:
+            for j in range(1, len(gen)):
+                remainder[i + j] ^= gf_mul(gen[j], coef)
+    return bytes(remainder[len(msg) :])
+
+
+def rs_syndromes(codeword, nsym):
+    return [gf_poly_eval(codeword, gf_pow(2, i)) for i in range(nsym)]
+
+
+# Berlekamp-Massey: the error locator polynomial, lowest degree first
+def _error_locator(synd, nsym):
+    err_loc = [1]
+    old_loc = [1]
+    for i in range(nsym):
+        delta = synd[i]
+        for j in range(1, len(err_loc)):
+            delta ^= gf_mul(err_loc[-(j + 1)], synd[i - j])
+        old_loc = old_loc + [0]
+        if delta != 0:
+            if len(old_loc) > len(err_loc):
+                new_loc = gf_poly_scale(old_loc, delta)
+                old_loc = gf_poly_scale(err_loc, gf_inverse(delta))
+                err_loc = new_loc
+            err_loc = gf_poly_add(err_loc, gf_poly_scale(old_loc, delta))
+    while len(err_loc) and err_loc[0] == 0:
+        del err_loc[0]
+    errs = len(err_loc) - 1
+    if errs * 2 > nsym:
+        raise ValueError("too many errors to correct")
+    return err_loc
+
+
+# Chien search for the positions (from the start of the codeword) of errors
+def _error_positions(err_loc, length):
+    errs = len(err_loc) - 1
+    positions = []
+    for i in range(length):
+        if gf_poly_eval(err_loc, gf_pow(2, i)) == 0:
+            positions.append(length - 1 - i)
+    if len(positions) != errs:
+        raise ValueError("could not locate errors")
+    return positions
+
+
+# Forney algorithm: error magnitudes at the known positions
+def _correct_errata(codeword, synd, positions):
+    length = len(codeword)
+    coef_pos = [length - 1 - p for p in positions]
+    errata_loc = [1]
+    for i in coef_pos:
+        errata_loc = gf_poly_mul(errata_loc, gf_poly_add([1], [gf_pow(2, i), 0]))
+    # error evaluator: (synd * errata_loc) mod x^(errors + 1), with the
+    # syndromes reversed and shifted up one degree
+    rev_synd = synd[::-1] + [0]
+    product = gf_poly_mul(rev_synd, errata_loc)
+    err_eval = product[len(product) - len(errata_loc) :]
+    locators = [gf_pow(2, i) for i in coef_pos]
+    corrected = list(codeword)
+    for i, x in enumerate(locators):
+        x_inv = gf_inverse(x)
+        loc_prime = 1
+        for j, other in enumerate(locators):
+            if j != i:
+                loc_prime = gf_mul(loc_prime, 1 ^ gf_mul(x_inv, other))
+        if loc_prime == 0:
+            raise ValueError("could not compute error magnitude")
+        y = gf_mul(x, gf_poly_eval(err_eval, x_inv))
+        corrected[positions[i]] ^= gf_div(y, loc_prime)
+    return corrected
+
+
+# Correct up to nsym // 2 byte errors in one codeword (message + parity)
+# returns the repaired message and the number of bytes fixed
+# raises ValueError if the codeword can't be repaired
+def rs_correct(codeword, nsym):
+    codeword = list(codeword)
+    synd = rs_syndromes(codeword, nsym)
+    if max(synd) == 0:
+        return bytes(codeword[:-nsym]), 0
+    err_loc = _error_locator(synd, nsym)
+    positions = _error_positions(err_loc[::-1], len(codeword))
+    corrected = _correct_errata(codeword, synd, positions)
+    if max(rs_syndromes(corrected, nsym)) != 0:
+        raise ValueError("could not correct errors")
+    return bytes(corrected[:-nsym]), len(positions)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3.8
+
+"""
+Replay a trace recorded with fldigi_proxy.py --record through the receive
+pipeline of an fl_instance, with no fldigi or radio, and report decode
+throughput, errors and per-frame latency as JSON
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import trio
+import trio.testing
+
+import util
+from benchmark import percentile
+from fldigi_client import fl_instance
+from radio_trace import KIND_RX, KIND_TX, read_trace
+
+logger = logging.getLogger("replay")
+
+
+class replay:
+    def __init__(self, args):
+        self.args = args
+        self.fl = fl_instance(
+            no_proxy=True,
+            connect=False,
+            arq_window=args.arq,
+            dedup_bytes=args.dedup,
+        )
+        self.fl.mux.accept_remote = True
+        self.fragments = 0
+        self.frames = 0
+        self.decode_errors = 0
+        # of the decode errors, partial frames that lost their suffix
+        self.cut_frames = 0
+        self.payload_bytes = 0
+        # seconds from feeding the fragment that completes each frame to the
+        # frame's data reaching its stream
+        self.latencies = []
+
+    # The trace's RX fragments, or with --tx its TX buffers as fldigi would
+    # hand them to the peer, newlines turned into CR LF
+    # returns (seconds, fragment) pairs
+    def records(self):
+        kind = KIND_TX if self.args.tx else KIND_RX
+        for record_kind, seconds, data in read_trace(self.args.trace):
+            if record_kind != kind:
+                continue
+            if kind == KIND_TX:
+                data = data.replace(b"\n", util.FRAME_SUFFIX)
+            yield seconds, data
+
+    async def drain(self, stream):
+        async with stream:
+            async for segment in stream.rx_receive:
+                self.payload_bytes += len(segment)
+
+    async def accept(self, nursery):
+        async for stream in self.fl.mux.incoming:
+            nursery.start_soon(self.drain, stream)
+
+    # Feed one fragment to the decoder, as get_fragment() would return it
+    async def feed(self, fragment):
+        self.fragments += 1
+        fed = time.perf_counter()
+        rx_decoder = self.fl.rx_decoder
+        cut_frames = rx_decoder.cut_frames
+        radio_buffers = rx_decoder.feed(fragment.replace(b" ", b""))
+        cut = rx_decoder.cut_frames - cut_frames
+        if cut:
+            logger.debug(f"dropping {cut} frames: their suffix was lost")
+            self.cut_frames += cut
+            self.decode_errors += cut
+        for radio_buffer in radio_buffers:
+            if await self.fl.frame_received(radio_buffer):
+                self.frames += 1
+                self.latencies.append(time.perf_counter() - fed)
+            else:
+                self.decode_errors += 1
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self.accept, nursery)
+            start = time.perf_counter()
+            replay_start = trio.current_time()
+            trace_start = None
+            trace_end = 0.0
+            for seconds, fragment in self.records():
+                if trace_start is None:
+                    trace_start = seconds
+                trace_end = seconds
+                if self.args.timing:
+                    await trio.sleep_until(replay_start + seconds - trace_start)
+                await self.feed(fragment)
+                # let the streams take their data
+                await trio.sleep(0)
+            await trio.testing.wait_all_tasks_blocked()
+            elapsed = time.perf_counter() - start
+            nursery.cancel_scope.cancel()
+        return self.report(elapsed, trace_end - (trace_start or 0.0))
+
+    def report(self, elapsed, trace_seconds):
+        latencies = sorted(self.latencies)
+        return {
+            "trace": self.args.trace,
+            "direction": "tx" if self.args.tx else "rx",
+            "timing": "original" if self.args.timing else "fast",
+            "trace_seconds": trace_seconds,
+            "elapsed": elapsed,
+            "fragments": self.fragments,
+            "frames": self.frames,
+            "decode_errors": self.decode_errors,
+            "cut_frames": self.cut_frames,
+            "payload_bytes": self.payload_bytes,
+            "frames_per_second": self.frames / elapsed if elapsed > 0 else None,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+
+async def main():
+    # fmt: off
+    parser = argparse.ArgumentParser(description="replay an fldigi-proxy trace through the receive pipeline")
+    parser.add_argument("trace", type=str, help="trace file recorded with fldigi_proxy.py --record")
+    parser.add_argument("--tx", help="replay the trace's TX buffers instead of its RX fragments", action="store_true")
+    parser.add_argument("--timing", help="feed fragments at their recorded times instead of as fast as possible", action="store_true")
+    parser.add_argument("--arq", type=int, help="ARQ window the recording proxy's peer used, to put frames back in order")
+    parser.add_argument("--dedup", type=int, help="dedup cache size the recording proxy's peer used")
+    parser.add_argument("--output", type=str, help="write the JSON results here instead of stdout")
+    parser.add_argument("--debug", default=False, help="log every dropped frame", action="store_true")
+    # fmt: on
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.ERROR,
+        format="%(name)-12s: %(levelname)-8s %(message)s",
+    )
+    results = json.dumps(await replay(args).run(), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,177 @@
+"""
+Append-only spool file of the frames ARQ has in flight, so a restarted proxy
+resends what the peer never acked and carries on with the same sequence
+numbers
+"""
+
+import logging
+import mmap
+import os
+
+import trio
+
+import util
+from arq import SEQ_SPACE
+
+logger = logging.getLogger("fldigi")
+
+MAGIC = b"FPS1"
+# Each record is a kind byte, a 4-byte body length, then the body
+RECORD_HEADER = 5
+# A frame ARQ numbered: its seq, then the frame packed as a payload
+KIND_FRAME = b"F"
+# The peer acked the last frame with this seq
+KIND_ACK = b"A"
+# The next seq we expect from the peer
+KIND_RX_NEXT = b"R"
+# The seq of the next new frame, written when compacting
+KIND_NEXT_SEQ = b"S"
+# Rewrite the spool with only the live records once it grows past this
+COMPACT_BYTES = 1 << 20
+
+
+def pack_frame(seq, frame):
+    stream_id, segments, fin, stream_seq = frame
+    flags = util.FLAG_FIN if fin else 0
+    header = util.frame_header(flags, stream=stream_id, stream_seq=stream_seq)
+    return bytes([seq]) + util.pack_payload(segments, False, header)
+
+
+def unpack_frame(body):
+    header, segments = util.unpack_payload(body[1:])
+    fin = bool(header.flags & util.FLAG_FIN)
+    return body[0], (header.stream, segments, fin, header.stream_seq)
+
+
+def record(kind, body):
+    return kind + len(body).to_bytes(4, "big") + body
+
+
+# The spool of one ARQ sender and receiver. Only the frames in flight are
+# kept in memory, at most one ARQ window of them; the file is read back
+# through mmap when the proxy starts.
+class frame_spool:
+    def __init__(self, path):
+        self.path = path
+        # seq -> frame record, for the frames not yet acked, oldest first
+        self.live = {}
+        self.rx_next = 0
+        self.next_seq = 0
+        # records were appended since the last fsync
+        self.unsynced = False
+        # the spool held state from an earlier run
+        self.resumed = False
+        self.recover()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+            self.sync()
+
+    # Replay the spool into live, next_seq and rx_next. A record cut short
+    # by a crash ends the replay, and is cut off so new records follow the
+    # last whole one.
+    def recover(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb") as spool_file:
+            with mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[: len(MAGIC)] != MAGIC:
+                    raise ValueError(f"{self.path} is not a frame spool")
+                self.resumed = True
+                pos = len(MAGIC)
+                while pos + RECORD_HEADER <= len(data):
+                    kind = data[pos : pos + 1]
+                    size = int.from_bytes(data[pos + 1 : pos + RECORD_HEADER], "big")
+                    end = pos + RECORD_HEADER + size
+                    if end > len(data):
+                        logger.warning(f"spool {self.path} ends mid-record, dropping it")
+                        break
+                    body = data[pos + RECORD_HEADER : end]
+                    if kind == KIND_FRAME:
+                        self.live.pop(body[0], None)
+                        self.live[body[0]] = data[pos:end]
+                        self.next_seq = (body[0] + 1) % SEQ_SPACE
+                    elif kind == KIND_ACK:
+                        self.live.pop(body[0], None)
+                    elif kind == KIND_RX_NEXT:
+                        self.rx_next = body[0]
+                    elif kind == KIND_NEXT_SEQ:
+                        self.next_seq = body[0]
+                    pos = end
+        if pos < os.path.getsize(self.path):
+            os.truncate(self.path, pos)
+        logger.info(
+            f"spool {self.path}: {len(self.live)} unacked frames, "
+            f"next seq {self.next_seq}, expecting seq {self.rx_next}"
+        )
+
+    # The unacked frames, oldest first, as (seq, frame)
+    def unacked(self):
+        return [unpack_frame(rec[RECORD_HEADER:]) for rec in self.live.values()]
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = False
+
+    # Make every record appended so far durable, with the fsync on a worker
+    # thread so the event loop carries on. The thread gets its own copy of
+    # the file descriptor, as compact() may close the file meanwhile.
+    async def commit(self):
+        if not self.unsynced:
+            return
+        self.unsynced = False
+        fd = os.dup(self.file.fileno())
+        try:
+            await trio.to_thread.run_sync(os.fsync, fd)
+        finally:
+            os.close(fd)
+
+    # Records reach the OS at once, and the disk at the next commit()
+    def append(self, rec):
+        self.file.write(rec)
+        self.file.flush()
+        self.unsynced = True
+        if self.file.tell() > COMPACT_BYTES:
+            self.compact()
+
+    def frame_added(self, seq, frame):
+        self.next_seq = (seq + 1) % SEQ_SPACE
+        rec = record(KIND_FRAME, pack_frame(seq, frame))
+        self.live.pop(seq, None)
+        self.live[seq] = rec
+        self.append(rec)
+
+    def frame_acked(self, seq):
+        if self.live.pop(seq, None) is not None:
+            self.append(record(KIND_ACK, bytes([seq])))
+
+    def rx_advanced(self, rx_next):
+        self.rx_next = rx_next
+        self.append(record(KIND_RX_NEXT, bytes([rx_next])))
+
+    # Forget every frame and restart both sequence numbers, after the peer
+    # lost its ARQ state
+    def reset(self):
+        self.live = {}
+        self.rx_next = 0
+        self.next_seq = 0
+        self.compact()
+
+    # Write the live records to a new file and swap it in, so a crash part
+    # way through leaves the old spool whole
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as tmp:
+            tmp.write(MAGIC + b"".join(self.live.values()))
+            tmp.write(record(KIND_RX_NEXT, bytes([self.rx_next])))
+            tmp.write(record(KIND_NEXT_SEQ, bytes([self.next_seq])))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "ab")
+        self.unsynced = False
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,353 @@
+"""
+Multiplex many TCP connections over one radio link: every frame names the
+stream it belongs to, one TX scheduler per fl_instance serves the streams in
+turn, and one RX demultiplexer hands each stream's data to its own port
+"""
+
+import collections
+import logging
+
+import trio
+
+import metrics
+import qos
+
+logger = logging.getLogger("fldigi")
+
+# Packets waiting on each direction of each stream
+QUEUE_SIZE = 16
+# Radio data waiting for its port. The RX demultiplexer serves every stream,
+# so it never waits for one: this is far more than the radio delivers while a
+# port that is reading drains it, and a stream whose queue fills is reset.
+RX_QUEUE_SIZE = 1024
+# Stream IDs are one byte in the frame header
+MAX_STREAMS = 256
+# So are the per-stream frame numbers used to reorder frames from bonded links
+STREAM_SEQ_SPACE = 256
+
+streams_open = metrics.gauge_metric("streams_open", "Streams currently open")
+queue_bytes = metrics.histogram_metric(
+    "tx_queue_bytes",
+    "Port data waiting for the radio when a transmission is put together",
+    buckets=metrics.BYTE_BUCKETS,
+)
+queue_wait = {
+    name: metrics.histogram_metric(
+        "tx_queue_wait_seconds",
+        "Time port data waits in its stream's queue",
+        priority=name,
+    )
+    for name in qos.CLASSES
+}
+
+
+# One proxied connection. The port side writes port data with send() and
+# closes its TX direction by closing the stream, which sends a FIN; data from
+# the radio arrives on rx_receive, which ends when the remote FIN arrives.
+class radio_stream:
+    def __init__(self, mux, stream_id):
+        self.mux = mux
+        self.stream_id = stream_id
+        # port data waiting for the radio, at most QUEUE_SIZE segments, when
+        # each segment was queued and its QoS class
+        self.tx_queue = collections.deque()
+        self.tx_queued_at = collections.deque()
+        self.tx_classes = collections.deque()
+        self.tx_space = trio.Event()
+        self.tx_closed = False
+        self.fin_sent = False
+        self.fin_received = False
+        self.rx_send, self.rx_receive = trio.open_memory_channel(RX_QUEUE_SIZE)
+        # frame numbering, when frames can arrive out of order
+        self.tx_seq = 0
+        self.rx_seq = 0
+        # stream_seq -> [segments, fin, time received] for frames ahead of rx_seq
+        self.rx_pending = {}
+        # set once a gap in the received frames couldn't be filled
+        self.broken = False
+
+    # when the queue is full we stop taking port data, so TCP flow control
+    # pushes back on the peer
+    async def send(self, data):
+        while len(self.tx_queue) >= QUEUE_SIZE:
+            await self.tx_space.wait()
+        if self.tx_closed:
+            raise trio.ClosedResourceError()
+        self.tx_queue.append(data)
+        self.tx_queued_at.append(trio.current_time())
+        self.tx_classes.append(self.mux.classifier.classify(data))
+        self.mux.stream_ready(self)
+
+    # A stream is served by the class of the segment at the head of its
+    # queue; its segments can't overtake each other
+    def tx_class(self):
+        if self.tx_classes:
+            return self.tx_classes[0]
+        return "default"
+
+    def segment_taken(self):
+        self.tx_space.set()
+        self.tx_space = trio.Event()
+
+    # Our side of the connection is done: send a FIN once the queue has gone out
+    def close(self):
+        self.rx_receive.close()
+        if not self.tx_closed:
+            self.tx_closed = True
+            self.mux.stream_ready(self)
+
+    # Radio data can't reach the port whole, because a gap in the received
+    # frames can't be filled or the port stopped reading: end the RX
+    # direction so the connection is torn down, rather than hand the port
+    # data with a hole in it
+    def reset(self):
+        self.broken = True
+        self.rx_pending.clear()
+        self.rx_send.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class stream_multiplexer:
+    # Open a connection for each stream the remote end starts; otherwise
+    # frames for unknown streams are dropped
+    accept_remote = False
+    # Number the frames of each stream so the receiver can put them back in
+    # order, for links that can reorder them
+    sequenced = False
+    # Every frame is retransmitted until it arrives, because the links run
+    # ARQ, so a gap in a stream's frames is always filled in the end
+    reliable = False
+    # Without ARQ, how long a gap in a stream's frames may hold up the frames
+    # after it before the stream is reset
+    reorder_timeout = 30.0
+    # How take() picks the next stream to serve: None for round robin, or
+    # one of qos.SCHEDULERS to serve streams by the class of their next segment
+    qos = None
+
+    def __init__(self):
+        self.streams = {}
+        self.next_id = 0
+        # streams with port data or a FIN to send, in round-robin order
+        self.ready = collections.deque()
+        self.tx_event = trio.Event()
+        # streams started by the remote end, for the proxy to connect
+        self.incoming_send, self.incoming = trio.open_memory_channel(QUEUE_SIZE)
+        # when the oldest segment the last take() returned was queued
+        self.last_queued_at = None
+        self.classifier = qos.classifier()
+        self.picker = qos.weighted_picker()
+
+    # A new stream, on the next free ID unless one is given
+    # raises RuntimeError when every stream ID is in use
+    def open_stream(self, stream_id=None):
+        if stream_id is None:
+            for _ in range(MAX_STREAMS):
+                candidate = self.next_id
+                self.next_id = (self.next_id + 1) % MAX_STREAMS
+                if candidate not in self.streams:
+                    stream_id = candidate
+                    break
+            else:
+                raise RuntimeError("no free stream IDs")
+        stream = radio_stream(self, stream_id)
+        self.streams[stream_id] = stream
+        streams_open.set(len(self.streams))
+        logger.info(f"opened stream {stream_id}")
+        return stream
+
+    # Forget a stream once both ends have sent their FIN
+    def retire(self, stream):
+        if stream.fin_sent and stream.fin_received:
+            if self.streams.get(stream.stream_id) is stream:
+                del self.streams[stream.stream_id]
+                streams_open.set(len(self.streams))
+            logger.info(f"closed stream {stream.stream_id}")
+
+    def stream_ready(self, stream):
+        if stream not in self.ready:
+            self.ready.append(stream)
+        self.tx_event.set()
+        self.tx_event = trio.Event()
+
+    def has_data(self):
+        return bool(self.ready)
+
+    def queued_bytes(self):
+        return sum(len(seg) for stream in self.ready for seg in stream.tx_queue)
+
+    # The ready stream take() serves next: strict QoS serves the most urgent
+    # class first, weighted QoS gives each class its share of turns
+    def next_stream(self):
+        if self.qos is None:
+            return self.ready[0]
+        classes = [stream.tx_class() for stream in self.ready]
+        if self.qos == "strict":
+            chosen = min(classes, key=qos.RANK.get)
+        else:
+            chosen = self.picker.pick(set(classes))
+        return self.ready[classes.index(chosen)]
+
+    # Wait until any stream queues port data or a FIN
+    async def wait_for_update(self):
+        await self.tx_event.wait()
+
+    async def wait_for_data(self):
+        while not self.ready:
+            await self.wait_for_update()
+
+    # Take frames for one transmission, one segment from each ready stream in
+    # the order next_stream() picks them until the byte or airtime budget is
+    # spent. The first segment always goes, and with max_frames set only that
+    # many frames are taken. With max_frame_airtime set, a stream's data
+    # starts a new frame once its frame is that long on air, and a segment
+    # that doesn't fit is cut, the rest waiting at the head of its queue.
+    # returns a list of (stream_id, segments, fin, stream_seq) frames
+    def take(
+            self,
+            max_bytes,
+            max_airtime,
+            segment_airtime,
+            max_frames=None,
+            max_frame_airtime=None,
+    ):
+        queue_bytes.observe(self.queued_bytes())
+        now = trio.current_time()
+        self.last_queued_at = None
+        # [stream, segments, airtime] for each frame, and each stream's last
+        frames = []
+        stream_frames = {}
+        size = 0
+        airtime = 0.0
+        while self.ready:
+            stream = self.next_stream()
+            frame = stream_frames.get(stream)
+            segment = stream.tx_queue[0] if stream.tx_queue else None
+            if segment is not None:
+                seconds = segment_airtime(segment)
+                if max_frame_airtime is not None:
+                    used = frame[2] if frame is not None else 0.0
+                    if used + seconds > max_frame_airtime:
+                        # codecs spend about the same airtime on every byte
+                        cut = int(len(segment) * (max_frame_airtime - used) / seconds)
+                        if cut == 0 and frame is not None:
+                            frame = None
+                            cut = int(len(segment) * max_frame_airtime / seconds)
+                        segment = segment[: max(cut, 1)]
+                        seconds = segment_airtime(segment)
+            if frame is None and max_frames is not None and len(frames) >= max_frames:
+                break
+            if segment is not None:
+                size += len(segment)
+                airtime += seconds
+                if frames and (size > max_bytes or airtime > max_airtime):
+                    break
+                queued_at = stream.tx_queued_at[0]
+                if len(segment) < len(stream.tx_queue[0]):
+                    stream.tx_queue[0] = stream.tx_queue[0][len(segment) :]
+                else:
+                    stream.tx_queue.popleft()
+                    stream.tx_queued_at.popleft()
+                    queue_wait[stream.tx_classes.popleft()].observe(now - queued_at)
+                    stream.segment_taken()
+                if self.last_queued_at is None or queued_at < self.last_queued_at:
+                    self.last_queued_at = queued_at
+            if frame is None and (segment is not None or stream.tx_closed):
+                frame = [stream, [], 0.0]
+                frames.append(frame)
+                stream_frames[stream] = frame
+            if segment is not None:
+                frame[1].append(segment)
+                frame[2] += seconds
+            self.ready.remove(stream)
+            if stream.tx_queue:
+                self.ready.append(stream)
+        taken = []
+        for frame in frames:
+            stream, segments, _ = frame
+            # a stream's FIN goes on its last frame
+            last = stream_frames[stream] is frame
+            fin = last and stream.tx_closed and not stream.tx_queue
+            if fin:
+                stream.fin_sent = True
+                self.retire(stream)
+            stream_seq = None
+            if self.sequenced:
+                stream_seq = stream.tx_seq
+                stream.tx_seq = (stream.tx_seq + 1) % STREAM_SEQ_SPACE
+            taken.append((stream.stream_id, segments, fin, stream_seq))
+        return taken
+
+    # Hand data from the radio to its stream, starting the stream if the
+    # remote end just opened it. Numbered frames are delivered in order.
+    async def deliver(self, stream_id, segments, fin, stream_seq=None):
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # A FIN with nothing before it would open and close the stream at
+            # once; it is most likely a late one for a stream we already closed
+            lone_fin = fin and not segments and not stream_seq
+            if not self.accept_remote or lone_fin:
+                logger.info(f"dropping frame for unknown stream {stream_id}")
+                return
+            stream = self.open_stream(stream_id)
+            try:
+                self.incoming_send.send_nowait(stream)
+            except trio.WouldBlock:
+                logger.warning(f"too many streams waiting to connect, refusing {stream_id}")
+                stream.close()
+        if stream_seq is None or stream.broken:
+            await self.deliver_frame(stream, segments, fin)
+            return
+        distance = (stream_seq - stream.rx_seq) % STREAM_SEQ_SPACE
+        if distance >= STREAM_SEQ_SPACE // 2:
+            logger.info(f"stream {stream_id} frame {stream_seq} is stale, dropping")
+            return
+        stream.rx_pending[stream_seq] = [segments, fin, trio.current_time()]
+        await self.deliver_in_order(stream)
+
+    async def deliver_in_order(self, stream):
+        while stream.rx_seq in stream.rx_pending:
+            segments, fin, _ = stream.rx_pending.pop(stream.rx_seq)
+            stream.rx_seq = (stream.rx_seq + 1) % STREAM_SEQ_SPACE
+            await self.deliver_frame(stream, segments, fin)
+
+    # Called every poll: reset streams with frames missing for
+    # reorder_timeout. Skipping the gap would punch a silent hole in the
+    # port data, so the connection is ended instead.
+    async def check_gaps(self):
+        if self.reliable:
+            return
+        now = trio.current_time()
+        for stream in list(self.streams.values()):
+            if not stream.rx_pending:
+                continue
+            oldest = min(received for _, _, received in stream.rx_pending.values())
+            if now - oldest < self.reorder_timeout:
+                continue
+            logger.error(
+                f"stream {stream.stream_id} frame {stream.rx_seq} missing for "
+                f"{self.reorder_timeout:.0f}s, resetting the stream"
+            )
+            stream.reset()
+
+    async def deliver_frame(self, stream, segments, fin):
+        stream_id = stream.stream_id
+        for segment in segments:
+            try:
+                stream.rx_send.send_nowait(segment)
+            except trio.WouldBlock:
+                logger.error(f"stream {stream_id} port stopped reading, resetting the stream")
+                stream.reset()
+                break
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                if not stream.broken:
+                    logger.info(f"stream {stream_id} closed locally, dropping data")
+                break
+        if fin and not stream.fin_received:
+            stream.fin_received = True
+            await stream.rx_send.aclose()
+            self.retire(stream)
@@ -3,21 +3,368 @@ Global utilities for data encode/decode + tests for fldigi-proxy <-> fldigi inte
 """
 
 import argparse
-import codecs
+import base64
+import binascii
+import random
+import time
+import zlib
+
+import qos
+import reed_solomon
+
+# Every radio frame is FRAME_PREFIX + codec frame_id + FEC id + encoded payload
+# + newline; fldigi hands the newline back to us as FRAME_SUFFIX
+FRAME_PREFIX = b"BT"
+FRAME_SUFFIX = b"\r\n"
+
+# PSK31 varicode for ASCII 0-127; every character is followed by a "00" gap
+# https://en.wikipedia.org/wiki/Varicode
+# fldigi's robust PSK-R modes use the MFSK varicode in airtime.MFSK_VARICODE
+# fmt: off
+VARICODE = (
+    "1010101011", "1011011011", "1011101101", "1101110111", "1011101011", "1101011111", "1011101111", "1011111101",
+    "1011111111", "11101111", "11101", "1101101111", "1011011101", "11111", "1101110101", "1110101011",
+    "1011110111", "1011110101", "1110101101", "1110101111", "1101011011", "1101101011", "1101101101", "1101010111",
+    "1101111011", "1101111101", "1110110111", "1101010101", "1101011101", "1110111011", "1011111011", "1101111111",
+    "1", "111111111", "101011111", "111110101", "111011011", "1011010101", "1010111011", "101111111",
+    "11111011", "11110111", "101101111", "111011111", "1110101", "110101", "1010111", "110101111",
+    "10110111", "10111101", "11101101", "11111111", "101110111", "101011011", "101101011", "110101101",
+    "110101011", "110110111", "11110101", "110111101", "111101101", "1010101", "111010111", "1010101111",
+    "1010111101", "1111101", "11101011", "10101101", "10110101", "1110111", "11011011", "11111101",
+    "101010101", "1111111", "111111101", "101111101", "11010111", "10111011", "11011101", "10101011",
+    "11010101", "111011101", "10101111", "1101111", "1101101", "101010111", "110110101", "101011101",
+    "101110101", "101111011", "1010101101", "111110111", "111101111", "111111011", "1010111111", "101101101",
+    "1011011111", "1011", "1011111", "101111", "101101", "11", "111101", "1011011",
+    "101011", "1101", "111101011", "10111111", "11011", "111011", "1111", "111",
+    "111111", "110111111", "10101", "10111", "101", "110111", "1111011", "1101011",
+    "11011111", "1011101", "111010101", "1010110111", "110111011", "1010110101", "1011010111", "1110110101",
+)
+# fmt: on
+VARICODE_GAP = 2
+
+
+# Bits on air for some text sent over a PSK varicode modem
+def varicode_bits(text):
+    return sum(len(VARICODE[c]) + VARICODE_GAP for c in text)
+
+
+# Standard base64; compact, but uppercase letters and digits are expensive in varicode
+class base64_codec:
+    name = "base64"
+    frame_id = b"C"
+
+    def encode(self, raw_bytes):
+        return base64.b64encode(raw_bytes)
+
+    def decode(self, text):
+        return base64.b64decode(text, validate=True)
+
+
+# Lowercase base32 without padding; cheap characters, but 60% size overhead
+class base32_codec:
+    name = "base32"
+    frame_id = b"L"
+
+    def encode(self, raw_bytes):
+        return base64.b32encode(raw_bytes).rstrip(b"=").lower()
+
+    def decode(self, text):
+        padding = b"=" * (-len(text) % 8)
+        return base64.b32decode(text.upper() + padding)
+
+
+# Prefix code that spends the fewest varicode bits per payload bit: cheap
+# characters carry short bit strings and expensive characters long ones.
+# Codeword lengths are assigned canonically from these groups, which fill the
+# code space exactly; '^' is left out since fldigi treats it as a TX command.
+# Uniform payload bytes cost ~10.8 bits on air, vs ~12.5 for base64
+class varicode_codec:
+    name = "varicode"
+    frame_id = b"V"
+    code_lengths = {
+        3: "e",
+        4: "ot",
+        5: "ainlrs",
+        6: "-cdfhmpu",
+        7: ',.=AEISTbgvwy()0123:BCDFGLMNOPRkx!"#',
+        8: "$'*+/456789;<>HJKQUVWXY[\\]_jqz|%&?@Z`{}~",
+    }
+    max_length = 8
+
+    def __init__(self):
+        # canonical code: codewords increase in order of (length, character)
+        self.codewords = {}
+        code = 0
+        previous_length = 0
+        for length in sorted(self.code_lengths):
+            code <<= length - previous_length
+            previous_length = length
+            for char in self.code_lengths[length].encode():
+                self.codewords[char] = format(code, f"0{length}b")
+                code += 1
+        # with no codeword longer than a byte, any 8-bit window starts with
+        # exactly one codeword
+        self.windows = [None] * (1 << self.max_length)
+        for char, codeword in self.codewords.items():
+            free_bits = self.max_length - len(codeword)
+            base = int(codeword, 2) << free_bits
+            for window in range(base, base + (1 << free_bits)):
+                self.windows[window] = (char, len(codeword))
+
+    def encode(self, raw_bytes):
+        bits = "".join(format(byte, "08b") for byte in raw_bytes)
+        text = bytearray()
+        pos = 0
+        # the last codeword is padded with zeros, which decode() drops again
+        while pos < len(bits):
+            window = bits[pos : pos + self.max_length].ljust(self.max_length, "0")
+            char, length = self.windows[int(window, 2)]
+            text.append(char)
+            pos += length
+        return bytes(text)
+
+    def decode(self, text):
+        try:
+            bits = "".join([self.codewords[char] for char in text])
+        except KeyError as e:
+            raise ValueError(f"invalid varicode codec character {e}") from None
+        # padding is always shorter than a byte
+        n_bytes = len(bits) // 8
+        if n_bytes == 0:
+            return b""
+        return int(bits[: n_bytes * 8], 2).to_bytes(n_bytes, "big")
+
+
+CODECS = {
+    codec.name: codec() for codec in (base64_codec, base32_codec, varicode_codec)
+}
+CODEC_IDS = {codec.frame_id: codec for codec in CODECS.values()}
+
+
+# Reed-Solomon parity bytes per block, and the character after the codec id
+# that tells the receiver which level a frame uses
+FEC_IDS = {0: b"e", 4: b"t", 8: b"o", 16: b"a", 32: b"i"}
+FEC_LEVELS = {fec_id: parity for parity, fec_id in FEC_IDS.items()}
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+# Number of Reed-Solomon blocks protecting n_data bytes
+def fec_blocks(n_data, parity):
+    return -(-n_data // (reed_solomon.BLOCK_SIZE - parity))
+
+
+# Append a CRC-16 to a frame payload and, when parity is set, Reed-Solomon
+# parity. Long payloads are split across blocks by taking every n-th byte, so
+# a burst of errors from one bad character is spread over several blocks.
+# The parity bytes are interleaved the same way and follow the data.
+def protect(payload, parity=0):
+    data = payload + crc16(payload).to_bytes(2, "big")
+    if parity == 0:
+        return data
+    n_blocks = fec_blocks(len(data), parity)
+    parities = [
+        reed_solomon.rs_parity(data[i::n_blocks], parity) for i in range(n_blocks)
+    ]
+    return data + bytes(block[j] for j in range(parity) for block in parities)
+
+
+# Inverse of protect(); returns the payload and the number of bytes repaired
+# raises ValueError when the frame can't be repaired
+def recover(data, parity=0):
+    corrected = 0
+    if parity:
+        # find the block count that matches this many data + parity bytes
+        n_blocks = 1
+        while fec_blocks(len(data) - n_blocks * parity, parity) > n_blocks:
+            n_blocks += 1
+        n_data = len(data) - n_blocks * parity
+        if n_data <= 0 or fec_blocks(n_data, parity) != n_blocks:
+            raise ValueError(f"frame length {len(data)} doesn't fit FEC blocks")
+        message = bytearray(data[:n_data])
+        parity_bytes = data[n_data:]
+        for i in range(n_blocks):
+            block = message[i::n_blocks] + parity_bytes[i::n_blocks]
+            fixed, count = reed_solomon.rs_correct(block, parity)
+            message[i::n_blocks] = fixed
+            corrected += count
+        data = bytes(message)
+    if len(data) < 2 or crc16(data[:-2]) != int.from_bytes(data[-2:], "big"):
+        raise ValueError("frame failed CRC check")
+    return data[:-2], corrected
+
+
+# After the codec id and FEC level, the length of the frame's encoded text in
+# LENGTH_CHARS lowercase base32 digits, so the receiver can tell when the frame
+# will end. It is only a hint, outside the CRC; longer texts give the largest.
+LENGTH_DIGITS = b"abcdefghijklmnopqrstuvwxyz234567"
+LENGTH_CHARS = 3
+MAX_LENGTH = len(LENGTH_DIGITS) ** LENGTH_CHARS - 1
+
+
+def encode_length(length):
+    length = min(length, MAX_LENGTH)
+    digits = bytearray()
+    for _ in range(LENGTH_CHARS):
+        length, digit = divmod(length, len(LENGTH_DIGITS))
+        digits[:0] = LENGTH_DIGITS[digit : digit + 1]
+    return bytes(digits)
+
+
+# raises ValueError on a character that isn't a length digit
+def decode_length(digits):
+    length = 0
+    for char in digits:
+        digit = LENGTH_DIGITS.find(char)
+        if digit == -1:
+            raise ValueError(f"bad frame length {digits}")
+        length = length * len(LENGTH_DIGITS) + digit
+    return length
+
+
+# Encode a frame payload for radio TX; the frame prefix tells the receiver
+# which codec and FEC level we used, so each end picks its own
+def encode_frame(payload, codec="varicode", parity=0):
+    codec = CODECS[codec]
+    text = codec.encode(protect(payload, parity))
+    header = FRAME_PREFIX + codec.frame_id + FEC_IDS[parity] + encode_length(len(text))
+    return header + text + b"\n"
+
+
+# Decode a frame body (prefix and suffix already stripped) back to its payload
+# returns the payload and the number of bytes FEC repaired
+# raises ValueError if the frame is corrupt beyond repair
+def decode_frame(frame):
+    try:
+        codec = CODEC_IDS[frame[:1]]
+        parity = FEC_LEVELS[frame[1:2]]
+    except KeyError:
+        raise ValueError(f"unknown codec or FEC level in frame: {frame[:2]}") from None
+    return recover(codec.decode(frame[2 + LENGTH_CHARS :]), parity)
+
+
+def frame_decodes(frame):
+    try:
+        decode_frame(frame)
+    except ValueError:
+        return False
+    return True
+
 
 # Convert raw data in a bytes() object to base64 for radio TX
 def raw_to_base64(raw_bytes, prefix=b"BTC"):
-    base64_buffer = codecs.encode(codecs.decode(raw_bytes.hex(), "hex"), "base64")
-    # need to strip the newlines added every 76 bytes; intended for MIME
-    # https://docs.python.org/3/library/base64.html#base64.encodebytes
-    stripped_buffer = base64_buffer.replace(b"\n", b"")
     # add static prefix to assist with accurate decoding
-    return prefix + stripped_buffer + b"\n"
+    return prefix + base64.b64encode(raw_bytes) + b"\n"
 
 
 # Convert base64-encoded RX radio data to raw bytes() object for port
 def base64_to_raw(base64_bytes):
-    return codecs.decode(base64_bytes, "base64")
+    return base64.b64decode(base64_bytes)
+
+
+# Incremental decoder for framed RX data: prefix + payload + suffix
+# fragments are appended to one buffer and the delimiter scan resumes where it
+# stopped, so every complete frame in a batch is returned and partial frames
+# carry over to the next feed()
+# A frame starts with the prefix followed by a known codec id and FEC level.
+# The same bytes can turn up inside an encoded payload, so a start inside a
+# frame may also mean the frame's suffix was lost and a new frame began. Only
+# the CRC can tell the two apart: once the suffix arrives, a frame that fails
+# to decode is cut at the first start after which the rest does decode.
+class frame_decoder:
+    def __init__(self, prefix=FRAME_PREFIX, suffix=FRAME_SUFFIX):
+        self.prefix = prefix
+        self.suffix = suffix
+        # prefix, codec id and FEC level
+        self.header_size = len(prefix) + 2
+        self.buffer = bytearray()
+        self.in_frame = False
+        # when the prefix of the frame being decoded, or the last frame start
+        # inside it, arrived
+        self.frame_started = None
+        # offsets in buffer of frame starts inside the frame being decoded
+        self.inner_starts = []
+        # offset in buffer where the next delimiter scan resumes
+        self.scan_start = 0
+        # partial frames dropped because their suffix was lost
+        self.cut_frames = 0
+
+    # Offset of the first frame start at or after pos, or -1. A prefix too
+    # close to the end of the buffer to check its ids isn't found yet.
+    def find_start(self, pos):
+        while True:
+            start = self.buffer.find(self.prefix, pos)
+            if start == -1:
+                return -1
+            ids = bytes(self.buffer[start + len(self.prefix) : start + self.header_size])
+            if len(ids) < 2:
+                return -1
+            if ids[:1] in CODEC_IDS and ids[1:] in FEC_LEVELS:
+                return start
+            pos = start + 1
+
+    # Characters still to come before the suffix of the frame being decoded,
+    # suffix included, by the length in the header of the last frame start,
+    # or None until that has arrived
+    def remaining_chars(self):
+        if not self.in_frame:
+            return None
+        header = self.inner_starts[-1] + len(self.prefix) if self.inner_starts else 0
+        digits = bytes(self.buffer[header + 2 : header + 2 + LENGTH_CHARS])
+        if len(digits) < LENGTH_CHARS:
+            return None
+        try:
+            length = decode_length(digits)
+        except ValueError:
+            return None
+        end = header + 2 + LENGTH_CHARS + length + len(self.suffix)
+        return end - len(self.buffer)
+
+    # The frame the text before a suffix holds: all of it, unless it only
+    # decodes from one of the frame starts inside it
+    def resolve(self, frame):
+        if not self.inner_starts or frame_decodes(frame):
+            return frame
+        for start in self.inner_starts:
+            tail = frame[start + len(self.prefix) :]
+            if frame_decodes(tail):
+                self.cut_frames += 1
+                return tail
+        return frame
+
+    def feed(self, fragment):
+        self.buffer += fragment
+        frames = []
+        while True:
+            if not self.in_frame:
+                start = self.find_start(self.scan_start)
+                if start == -1:
+                    # keep enough of the tail to match a start split across fragments
+                    keep = self.header_size - 1
+                    del self.buffer[: max(len(self.buffer) - keep, 0)]
+                    self.scan_start = 0
+                    return frames
+                # drop noise before the prefix, along with the prefix itself
+                del self.buffer[: start + len(self.prefix)]
+                self.in_frame = True
+                self.frame_started = time.time()
+                self.inner_starts = []
+                self.scan_start = 0
+            end = self.buffer.find(self.suffix, self.scan_start)
+            restart = self.find_start(self.scan_start)
+            while restart != -1 and (end == -1 or restart < end):
+                self.inner_starts.append(restart)
+                self.frame_started = time.time()
+                restart = self.find_start(restart + 1)
+            if end == -1:
+                self.scan_start = max(len(self.buffer) - self.header_size + 1, 0)
+                return frames
+            frames.append(self.resolve(bytes(self.buffer[:end])))
+            del self.buffer[: end + len(self.suffix)]
+            self.in_frame = False
+            self.scan_start = 0
 
 
 def test_standard():
@@ -29,7 +376,7 @@ def test_standard():
     return test_strings
 
 
-def test_raw():
+def test_raw_handshakes():
     # Lightning handshake messages captured from lnproxy
     test_handshake_0 = b"\x00\x03U\xc7\xaa\xa3\x85\xe8%\x95M\x96\xcbQ\x80C\x04\x0f\xf0\x14\xcf\x10\x11{t\x93=\x9d}\xa8a\xf5r\x02w\xca;\x11\xa1T\xaa\x81\xbf\xf2\xcbr\xd5;\xa9\xb2"
     test_handshake_1 = b"\x00\x02L\xdf\xd9\x81\x98\xcfr\xd8\xa7d\xd2\x167\x98\xff\x9b\t\x16\x1cR\x82^\x96\t8\xfb[\x9fv\x15d\n\xc0\xf7Wi\xf2\x1f\x9f\xd6ht\xba.\xf0>\\\x1c"
@@ -41,6 +388,11 @@ def test_raw():
         test_handshake_2,
         test_handshake_3,
     ]
+    return handshakes
+
+
+def test_raw():
+    handshakes = test_raw_handshakes()
     handshakes_base64 = []
     hs_test = True
     for hs_message in handshakes:
@@ -62,19 +414,454 @@ def test_raw():
         return handshakes_base64
 
 
+# Deterministic checks of the ARQ, spool and FEC code; each prints what went
+# wrong and returns False, or returns True. The modules they check import
+# this one, so they are imported here.
+def test_rs():
+    rng = random.Random(1)
+    payload = bytes(rng.randrange(256) for _ in range(600))
+    for parity in FEC_IDS:
+        if parity == 0:
+            continue
+        data = protect(payload, parity)
+        n_data = len(payload) + 2
+        n_blocks = fec_blocks(n_data, parity)
+        # parity // 2 bad bytes in every block is the most RS can repair
+        for errors in (parity // 2, parity // 2 + 1):
+            damaged = bytearray(data)
+            for block in range(n_blocks):
+                positions = range(block, n_data, n_blocks)
+                for pos in rng.sample(positions, errors):
+                    damaged[pos] ^= rng.randrange(1, 256)
+            try:
+                recovered, corrected = recover(bytes(damaged), parity)
+            except ValueError:
+                recovered, corrected = None, None
+            if errors == parity // 2 and (
+                recovered != payload or corrected != errors * n_blocks
+            ):
+                print(f"parity {parity}: {errors} errors per block not repaired")
+                return False
+            if errors > parity // 2 and recovered is not None:
+                print(f"parity {parity}: {errors} errors per block passed")
+                return False
+    return True
+
+
+# A spool cut short part way through a record resumes from the records before
+# it, and keeps working after the restart
+def test_spool():
+    import os
+    import tempfile
+    from arq import selective_repeat
+    from spool import frame_spool
+
+    frames = [(1, [b"segment %d" % seq], False, None) for seq in range(8)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "frames.spool")
+        spool = frame_spool(path)
+        for seq in range(6):
+            spool.frame_added(seq, frames[seq])
+        spool.frame_acked(0)
+        spool.frame_acked(2)
+        spool.rx_advanced(7)
+        spool.frame_added(6, frames[6])
+        spool.close()
+        # a crash part way through writing the last record
+        with open(path, "r+b") as spool_file:
+            spool_file.truncate(os.path.getsize(path) - 3)
+        spool = frame_spool(path)
+        arq = selective_repeat(window=8, spool=spool)
+        unacked = {seq: entry[0] for seq, entry in arq.unacked.items()}
+        if unacked != {seq: frames[seq] for seq in (1, 3, 4, 5)}:
+            print(f"spool resumed with frames {sorted(unacked)}, not 1, 3, 4 and 5")
+            return False
+        if (arq.next_seq, arq.rx_next, arq.syn) != (6, 7, False):
+            print(f"spool resumed at seq {arq.next_seq}, expecting {arq.rx_next}")
+            return False
+        # records written after the restart are read back on the next one
+        arq.add(frames[7])
+        arq.process_ack(4, 0)
+        spool.close()
+        spool = frame_spool(path)
+        unacked = {seq: frame for seq, frame in spool.unacked()}
+        spool.close()
+        if unacked != {seq: frames[7 if seq == 6 else seq] for seq in (4, 5, 6)}:
+            print(f"spool lost records written after a resume: {sorted(unacked)}")
+            return False
+    return True
+
+
+# One sender and one receiver over a link that loses a share of the frames in
+# each direction: each round the receiver acks if it owes an ack, then the
+# sender sends what is due. returns the frames delivered
+async def arq_rounds(sender, receiver, rounds, loss, rng, frames):
+    import trio
+
+    delivered = []
+    for _ in range(rounds):
+        if receiver.has_work():
+            ack = receiver.header(0)
+            receiver.frames_sent([])
+            if rng.random() >= loss:
+                sender.frame_received(ack, None)
+        await trio.sleep(1)
+        while frames and sender.window_open():
+            sender.add(frames.pop(0))
+        due = sender.due_frames()
+        sender.frames_sent([seq for seq, _ in due])
+        for seq, frame in due:
+            if rng.random() >= loss:
+                header = sender.header(FLAG_ARQ, seq)
+                delivered += receiver.frame_received(header, frame)
+        await trio.sleep(1)
+    return delivered
+
+
+# Frames numbered past the wraparound of the ARQ sequence numbers, with a
+# third of the frames and acks lost, arrive once each and in order
+def test_arq():
+    import trio
+    import trio.testing
+    from arq import SEQ_SPACE, selective_repeat
+
+    async def run():
+        sender = selective_repeat(window=8)
+        receiver = selective_repeat(window=8)
+        frames = list(range(2 * SEQ_SPACE + 50))
+        rng = random.Random(2)
+        delivered = await arq_rounds(sender, receiver, 2000, 0.3, rng, frames[:])
+        if delivered != frames:
+            print(f"ARQ delivered {len(delivered)} of {len(frames)} frames, or out of order")
+            return False
+        return True
+
+    return trio.run(run, clock=trio.testing.MockClock(autojump_threshold=0))
+
+
+# A receiver that restarts without a spool resyncs with the sender, which
+# renumbers its frames in flight and sends them again
+def test_arq_resync():
+    import trio
+    import trio.testing
+    from arq import selective_repeat
+
+    async def run():
+        sender = selective_repeat(window=8)
+        receiver = selective_repeat(window=8)
+        frames = list(range(300))
+        pending = frames[:]
+        rng = random.Random(3)
+        before = await arq_rounds(sender, receiver, 60, 0.3, rng, pending)
+        # the new receiver gets the frames unacked at the restart, then the rest
+        in_flight = sorted(entry[0] for entry in sender.unacked.values())
+        expected = in_flight + pending
+        receiver = selective_repeat(window=8)
+        after = await arq_rounds(sender, receiver, 2000, 0.3, rng, pending)
+        if before != frames[: len(before)] or after != expected:
+            print("ARQ frames lost, repeated or reordered across the restart")
+            return False
+        if sender.peer_restarts != 1:
+            print(f"ARQ sender saw {sender.peer_restarts} restarts, not 1")
+            return False
+        return True
+
+    return trio.run(run, clock=trio.testing.MockClock(autojump_threshold=0))
+
+
+# Flags in the header byte that starts every frame payload
+FLAG_COMPRESSED = 0x01
+FLAG_BATCH = 0x02
+# End of a transmission: the receiver may transmit next
+FLAG_TURN = 0x04
+# A sequence number byte follows the flags
+FLAG_ARQ = 0x08
+# A cumulative ack byte and a 16-bit selective ack bitmap follow
+FLAG_ACK = 0x10
+# A stream ID byte follows
+FLAG_STREAM = 0x20
+# The sender has closed this stream; no more data follows on it
+FLAG_FIN = 0x40
+# An extension flags byte follows, flagging the EXT_ fields after it
+FLAG_EXT = 0x80
+# A modem rate proposal or accept byte follows, see rate_adapt
+EXT_RATE = 0x01
+# A byte numbering the frame within its stream follows, for reordering frames
+# striped across bonded links
+EXT_STREAM_SEQ = 0x02
+# Every segment of the body starts with a dedup tag byte, see dedup
+EXT_DEDUP = 0x04
+# The sender's ARQ state is fresh: its frames are numbered from 0 and it knows
+# nothing of ours, see arq.selective_repeat. A 16-bit ID of the fresh state
+# follows.
+EXT_SYN = 0x08
+# The sender has reset its ARQ receiver for our SYN, so its acks count our
+# new frames. The ID of the SYN it answers follows.
+EXT_SYN_ACK = 0x10
+# Flags describing how the body is packed, set by pack_payload() itself
+BODY_FLAGS = FLAG_COMPRESSED | FLAG_BATCH
+
+# Largest payload we will inflate a compressed frame to
+MAX_PAYLOAD = 1 << 16
+
+
+# Preset dictionary for deflate, built only from structure that repeats in
+# the lnproxy traffic we carry: 2-byte message types, the fixed fields that
+# follow them, common TLV headers, and chain hashes. Keys, nonces and MACs are
+# random on every connection, so nothing captured from a real session goes in.
+# zlib weights the end of the dictionary most, so the commonest strings go last.
+# Both ends must use the same dictionary; change it only together with the
+# frame format.
+def lightning_zdict():
+    chain_hashes = [
+        # testnet, mainnet and regtest genesis block hashes, in wire byte order
+        bytes.fromhex(
+            "43497fd7f826957108f4a30fd9cec3aeba79092098e90ead01ea330900000000"
+        ),
+        bytes.fromhex(
+            "6fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000"
+        ),
+        bytes.fromhex(
+            "06226e46111a0b59caaf126043eb5bbf28c34f3a5e332a1fc7b2b73cf188910f"
+        ),
+    ]
+    # BOLT 1/2/7 message types: init, error, ping, pong, channel setup and
+    # close, HTLC updates, then gossip
+    message_types = [
+        16, 17, 18, 19, 32, 33, 34, 35, 36, 38, 39, 128, 130, 131, 132, 133, 134,
+        135, 136, 256, 257, 258, 259, 261, 263, 264, 265,
+    ]
+    zdict = b"".join(msg_type.to_bytes(2, "big") for msg_type in message_types)
+    # pong, then ping: type, 2-byte lengths and the zero padding they ask for
+    zdict += b"\x00\x13\x00\x04" + b"\x00" * 4
+    zdict += b"\x00\x12\x00\x04\x00\x04" + b"\x00" * 4
+    # noise handshake acts: version byte, then the parity byte of a compressed
+    # public key
+    zdict += b"\x00\x02\x00\x03"
+    zdict += b"\x00" * 32
+    # init: type and short feature lengths, then the networks TLV (type 1)
+    # listing 32-byte chain hashes
+    zdict += b"\x00\x10\x00\x02"
+    zdict += b"".join(b"\x01\x20" + chain_hash for chain_hash in chain_hashes)
+    return zdict
+
+
+LIGHTNING_ZDICT = lightning_zdict()
+
+
+# Raw deflate (no zlib header or checksum) primed with LIGHTNING_ZDICT
+def compress(raw_bytes):
+    compressor = zlib.compressobj(
+        zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15, zdict=LIGHTNING_ZDICT
+    )
+    return compressor.compress(raw_bytes) + compressor.flush()
+
+
+def decompress(body):
+    decompressor = zlib.decompressobj(-15, zdict=LIGHTNING_ZDICT)
+    try:
+        raw_bytes = decompressor.decompress(body, MAX_PAYLOAD)
+    except zlib.error as e:
+        raise ValueError(f"corrupt compressed payload: {e}") from None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("compressed payload truncated or too large")
+    return raw_bytes
+
+
+# Link-layer fields at the start of every frame payload: the flags byte, then
+# the fields the flags say are present
+class frame_header:
+    def __init__(
+            self,
+            flags=0,
+            seq=None,
+            ack=None,
+            ack_bitmap=0,
+            stream=None,
+            rate=None,
+            stream_seq=None,
+            dedup=False,
+            syn=None,
+            syn_ack=None,
+    ):
+        self.flags = flags
+        self.seq = seq
+        self.ack = ack
+        self.ack_bitmap = ack_bitmap
+        self.stream = stream
+        self.rate = rate
+        self.stream_seq = stream_seq
+        self.dedup = dedup
+        self.syn = syn
+        self.syn_ack = syn_ack
+
+    def pack(self, body_flags=0):
+        field_flags = FLAG_ARQ | FLAG_ACK | FLAG_STREAM | FLAG_EXT
+        flags = self.flags & ~(BODY_FLAGS | field_flags)
+        flags |= body_flags
+        fields = bytearray()
+        if self.seq is not None:
+            flags |= FLAG_ARQ
+            fields.append(self.seq)
+        if self.ack is not None:
+            flags |= FLAG_ACK
+            fields.append(self.ack)
+            fields += self.ack_bitmap.to_bytes(2, "big")
+        if self.stream is not None:
+            flags |= FLAG_STREAM
+            fields.append(self.stream)
+        ext = 0
+        ext_fields = bytearray()
+        if self.rate is not None:
+            ext |= EXT_RATE
+            ext_fields.append(self.rate)
+        if self.stream_seq is not None:
+            ext |= EXT_STREAM_SEQ
+            ext_fields.append(self.stream_seq)
+        if self.dedup:
+            ext |= EXT_DEDUP
+        if self.syn is not None:
+            ext |= EXT_SYN
+            ext_fields += self.syn.to_bytes(2, "big")
+        if self.syn_ack is not None:
+            ext |= EXT_SYN_ACK
+            ext_fields += self.syn_ack.to_bytes(2, "big")
+        if ext:
+            flags |= FLAG_EXT
+            fields += bytes([ext]) + ext_fields
+        return bytes([flags]) + fields
+
+    # returns the header and the offset of the body in payload
+    # raises ValueError if the payload ends inside the header
+    @classmethod
+    def unpack(cls, payload):
+        if not payload:
+            raise ValueError("empty payload")
+        flags = payload[0]
+        header = cls(flags)
+        pos = 1
+
+        def field(size=1):
+            nonlocal pos
+            if pos + size > len(payload):
+                raise ValueError("payload too short for its header")
+            pos += size
+            return int.from_bytes(payload[pos - size : pos], "big")
+
+        if flags & FLAG_ARQ:
+            header.seq = field()
+        if flags & FLAG_ACK:
+            header.ack = field()
+            header.ack_bitmap = field(2)
+        if flags & FLAG_STREAM:
+            header.stream = field()
+        if flags & FLAG_EXT:
+            ext = field()
+            if ext & EXT_RATE:
+                header.rate = field()
+            if ext & EXT_STREAM_SEQ:
+                header.stream_seq = field()
+            header.dedup = bool(ext & EXT_DEDUP)
+            if ext & EXT_SYN:
+                header.syn = field(2)
+            if ext & EXT_SYN_ACK:
+                header.syn_ack = field(2)
+        return header, pos
+
+
+# Build a frame payload from a header and one or more segments of port data,
+# each with a 2-byte length when there are several.
+# The body is compressed when that makes the frame smaller.
+def pack_payload(segments, use_compression=True, header=None):
+    if header is None:
+        header = frame_header()
+    body_flags = 0
+    if len(segments) == 1:
+        body = segments[0]
+    else:
+        body_flags |= FLAG_BATCH
+        body = b"".join(len(seg).to_bytes(2, "big") + seg for seg in segments)
+    if use_compression:
+        compressed = compress(body)
+        if len(compressed) < len(body):
+            body_flags |= FLAG_COMPRESSED
+            body = compressed
+    return header.pack(body_flags) + body
+
+
+# Inverse of pack_payload, returning the frame_header and the list of segments
+# raises ValueError for a malformed payload
+def unpack_payload(payload):
+    header, pos = frame_header.unpack(payload)
+    body = payload[pos:]
+    if header.flags & FLAG_COMPRESSED:
+        body = decompress(body)
+    if not header.flags & FLAG_BATCH:
+        return header, [body]
+    segments = []
+    pos = 0
+    while pos < len(body):
+        end = pos + 2 + int.from_bytes(body[pos : pos + 2], "big")
+        if end > len(body):
+            raise ValueError("batch segment runs past the end of the payload")
+        segments.append(body[pos + 2 : end])
+        pos = end
+    return header, segments
+
+
 def parse_args():
     # fmt: off
     parser = argparse.ArgumentParser(description="Talk to fldigi.")
-    parser.add_argument("--xml", type=int, help="XML-RPC port")
+    parser.add_argument("--xml", type=int, nargs="+", help="XML-RPC port; give several to bond fldigi instances into one link")
     parser.add_argument("--nohead", help="run fldigi without a GUI", action="store_true")
     parser.add_argument("--noproxy", help="run without TCP proxy functionality", action="store_true")
     parser.add_argument("--proxy_in", type=int, help="TCP port lnproxy listening on for inbound connections from node")
     parser.add_argument("--proxy_out", type=int, help="TCP port for lnproxy to connect to when making outbound connections to node")
-    parser.add_argument("--carrier", type=int, help="set carrier frequency in Hz; disables AFC")
+    parser.add_argument("--carrier", type=int, nargs="+", help="set carrier frequency in Hz, one per XML-RPC port; disables AFC")
     parser.add_argument("--modem", type=str, help="select a specific modem")
     parser.add_argument('--rigmode', type=str, help="select a transceiver mode")
+    parser.add_argument("--nocompress", help="never compress frames we transmit", action="store_true")
+    parser.add_argument("--batch_bytes", type=int, help="most bytes of port data to send in one transmission")
+    parser.add_argument("--batch_airtime", type=float, help="most seconds of airtime to spend on one transmission")
+    parser.add_argument("--access", type=str, choices=["fixed", "turn"], help="how to decide when we may transmit")
+    parser.add_argument("--fec", type=int, choices=sorted(FEC_IDS), help="Reed-Solomon parity bytes per block in frames we transmit; needs a fixed-width --codec, base64 unless given")
+    parser.add_argument("--arq", type=int, help="selective-repeat ARQ window in frames (1-16); off by default")
+    parser.add_argument("--adapt", help="step the modem up and down with link quality, agreed with the peer", action="store_true")
+    parser.add_argument("--dedup", type=int, help="cache up to this many bytes of recent port data at both ends and send repeats as references; needs --arq")
+    parser.add_argument("--qos", type=str, choices=["strict", "weighted"], help="serve control and payment messages before gossip, strictly or by weighted shares")
+    parser.add_argument("--qos_rule", type=str, nargs="+", default=[], help="TYPE=CLASS rules putting Lightning message types in a QoS class: control, payment, default or gossip")
+    parser.add_argument("--spool", type=str, help="keep frames awaiting an ARQ ack in this file, and resend them after a restart; needs --arq")
+    parser.add_argument("--record", type=str, help="record every RX fragment and TX buffer to this trace file, for replay.py")
+    parser.add_argument("--stream_tx", help="keep feeding fldigi's TX buffer while there is data, keying down only when it runs out", action="store_true")
+    parser.add_argument("--codec", type=str, choices=sorted(CODECS), help="payload encoding for frames we transmit")
+    parser.add_argument("--metrics_port", type=int, help="serve metrics in Prometheus text format on this local HTTP port")
+    parser.add_argument("--metrics_file", type=str, help="append a JSON line of every metric to this file periodically")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="seconds between lines in --metrics_file")
     # fmt: on
     args = parser.parse_args()
+    if args.xml is not None and len(args.xml) > 1:
+        if args.carrier is None or len(args.carrier) != len(args.xml):
+            parser.error("bonding needs one --carrier per --xml port")
+    elif args.carrier is not None and len(args.carrier) > 1:
+        parser.error("give one --xml port per --carrier")
+    try:
+        qos.classifier(args.qos_rule)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.fec:
+        # a bad varicode character shifts every byte after it, so FEC could
+        # only repair a frame whose damage happens to keep byte alignment
+        if args.codec is None:
+            args.codec = "base64"
+        elif args.codec == "varicode":
+            parser.error("--fec needs a fixed-width codec: --codec base64 or base32")
+    if args.dedup is not None and args.arq is None:
+        parser.error("--dedup needs --arq to keep both ends' caches in step")
+    if args.spool is not None:
+        if args.arq is None:
+            parser.error("--spool needs --arq to know which frames were acked")
+        if args.dedup is not None:
+            parser.error("--spool can't resume the dedup cache, so can't be used with --dedup")
     print(
         "args:",
         args.xml,
@@ -88,34 +875,38 @@ def parse_args():
     return args
 
 
-def fl_radio_settings(fl_main, args):
+# Apply every setting and read fldigi's state back in one round trip, then
+# report what we did
+def fl_radio_settings(fl_main, args, carrier=None):
+    rigmode = args.rigmode if args.rigmode is not None else "USB"
+    modem = args.modem if args.modem is not None else "PSK125R"
+    default_carrier = carrier is None
+    if default_carrier:
+        carrier = 1500
+    fl_main.configure(
+        [
+            ("rig.mode", rigmode),
+            ("modem.name", modem),
+            ("modem.carrier", carrier),
+            ("main.afc", False),
+        ]
+    )
     print(fl_main.version())
     fl_main.port_info()
     fl_main.rig_info()
     fl_main.modem_info()
     if args.rigmode is not None:
-        fl_main.rig_modify(mode=args.rigmode)
         print("transceiver mode now", args.rigmode)
     else:
         print("Defaulting to USB transceiver mode")
-        fl_main.rig_modify(mode="USB")
     if args.modem is not None:
-        fl_main.modem_modify(modem=args.modem)
-        print("modem now", args.modem)
+        print("modem now", fl_main.settings["modem.name"])
     else:
         print("Defaulting to PSK125R")
-        fl_main.modem_modify(modem="PSK125R")
-    if fl_main.fl_client.modem.name in fl_main.modem_timeout_multipliers:
-        fl_main.send_timeout_multiplier = fl_main.modem_timeout_multipliers[
-            fl_main.fl_client.modem.name
-        ]
-    else:
-        print("No stored multiplier for how many seconds per byte your modem will do")
-        print("Defaulting to multiplier for PSK125R")
-        fl_main.send_timeout_multiplier = fl_main.modem_timeout_multipliers["PSK125R"]
-    if args.carrier is not None:
-        fl_main.modem_modify(carrier=args.carrier)
-        print("carrier frequency now", args.carrier, "Hz, AFC off")
-    else:
+    fl_main.use_modem_rates(fl_main.settings["modem.name"])
+    if fl_main.rate is not None:
+        fl_main.rate.start(fl_main.settings["modem.name"])
+    if default_carrier:
         print("Defaulting to 1500 Hz carrier with AFC off")
-        fl_main.modem_modify(carrier=1500)
+    else:
+        print("carrier frequency now", carrier, "Hz, AFC off")